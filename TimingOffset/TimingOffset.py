@@ -26,74 +26,685 @@
 # ---------------------------------------------------------------------
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import contextlib
+from datetime import datetime
+import fractions
+import hashlib
+import importlib.util
+import io
+import json
 import os
 from pathlib import Path
 import platform
 import math
+import mmap
 import numpy as np
 import re
+from numpy.lib.stride_tricks import sliding_window_view
 from sklearn.preprocessing import StandardScaler
+import signal
+import shutil
+import socketserver
+import struct
+import subprocess
 import sys
 import tempfile
+import threading
+import time
+import tracemalloc
 import typing
 
-if platform.system() == "Windows":
-    os.system("")
-
 fps_num = 24000
 fps_den = 1001
 def print_frame(frame: int) -> str:
     return f"frame {frame} ({frame // (fps_num / fps_den * 60):02.0f}:{(frame % (fps_num / fps_den * 60)) // (fps_num / fps_den):02.0f})"
 def print_offset(offset: int) -> str:
-    if offset < 240:
-        return f"{str(offset - 240)}f"
+    if offset < 0:
+        return f"{str(offset)}f"
     else:
-        return f"+{str(offset - 240)}f"
+        return f"+{str(offset)}f"
 
-def get_keyframes_keyframe_format(f: typing.TextIO) -> list[int]:
-    lines = []
-    while True:
-        try:
-            line = f.readline()
-        except UnicodeDecodeError:
+# Profiling for --profile. Each stage is recorded as a complete event in
+# the Chrome trace event format with its wall time, the bytes it read and
+# the peak memory it allocated on top of what was allocated before it.
+# profile_events is None when profiling is off, so that profile_stage
+# costs no more than a function call.
+profile_events = None
+profile_stack = []
+
+@contextlib.contextmanager
+def profile_stage(name: str, **args) -> typing.Iterator[None]:
+    if profile_events is None:
+        yield
+        return
+
+    if profile_stack:
+        profile_stack[-1]["peak"] = max(profile_stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    stage = {"bytes": 0, "peak": base}
+    profile_stack.append(stage)
+    timestamp = time.time_ns() // 1000
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        profile_stack.pop()
+        stage["peak"] = max(stage["peak"], tracemalloc.get_traced_memory()[1])
+        if profile_stack:
+            profile_stack[-1]["bytes"] += stage["bytes"]
+            profile_stack[-1]["peak"] = max(profile_stack[-1]["peak"], stage["peak"])
+        profile_events.append({"name": name, "cat": "TimingOffset", "ph": "X", "ts": timestamp, "dur": duration * 1000000, "pid": os.getpid(), "tid": 0,
+                               "args": {**args, "bytes_read": stage["bytes"], "peak_memory": stage["peak"] - base}})
+
+def profile_read(size: int) -> None:
+    if profile_stack:
+        profile_stack[-1]["bytes"] += size
+
+class ProfiledReader(io.BufferedReader):
+    def read(self, size: typing.Optional[int] = -1) -> bytes:
+        data = super().read(size)
+        profile_read(len(data))
+        return data
+
+def open_file(path: Path) -> typing.BinaryIO:
+    if profile_events is None:
+        return path.open("rb")
+    else:
+        return ProfiledReader(io.FileIO(path))
+
+def start_profile() -> None:
+    global profile_events
+
+    profile_events = []
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size:.0f} B"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+# Writes the trace and returns the summary table, with the inclusive
+# totals of each stage followed by the total of each episode.
+def finish_profile(path: Path) -> str:
+    with path.open("w", encoding="utf-8") as f:
+        json.dump({"traceEvents": profile_events, "displayTimeUnit": "ms"}, f)
+
+    stages = {}
+    for event in profile_events:
+        if event["name"] == "episode":
             continue
-        if not line:
+        stage = stages.setdefault(event["name"], [0, 0.0, 0, 0])
+        stage[0] += 1
+        stage[1] += event["dur"] / 1000000
+        stage[2] += event["args"]["bytes_read"]
+        stage[3] = max(stage[3], event["args"]["peak_memory"])
+    episodes = [event for event in profile_events if event["name"] == "episode"]
+
+    message = f"\033[1;37m{'Stage':<24}{'Calls':>8}{'Wall time':>12}{'Bytes read':>14}{'Peak memory':>14}\033[0m\n"
+    for name, (calls, duration, size, peak) in stages.items():
+        message += f"{name:<24}{calls:>8}{duration:>10.3f} s{format_size(size):>14}{format_size(peak):>14}\n"
+    for event in episodes:
+        name = f"Episode {event['args']['episode']:02g}" if event["args"]["episode"] is not None else event["args"]["right"]
+        message += f"{name[:23]:<24}{'':>8}{event['dur'] / 1000000:>10.3f} s{format_size(event['args']['bytes_read']):>14}{format_size(event['args']['peak_memory']):>14}\n"
+    message += f"\033[1;37mTrace written to \033[0m\"{path.as_posix()}\"\033[1;37m.\033[0m\n"
+    return message
+
+# Keyframes are only 1 to 5% of all frames, so they are passed around as
+# the sorted frame numbers of the keyframes instead of an array of bools
+# for every frame. length is the number of frames in the clip, or None
+# for keyframe format files which don't record it.
+class Keyframes(typing.NamedTuple):
+    frames: np.ndarray[np.int32]
+    length: typing.Optional[int]
+
+def pack_keyframes(keyframes: np.ndarray[bool]) -> Keyframes:
+    return Keyframes(np.flatnonzero(keyframes).astype(np.int32), keyframes.shape[0])
+
+# Index files for long videos can have millions of lines. They are
+# memory-mapped and scanned with NumPy instead of being read line by line.
+def map_file(path: Path, scan: typing.Callable[[np.ndarray[np.uint8]], np.ndarray]) -> np.ndarray:
+    with open_file(path) as f:
+        if (size := f.seek(0, os.SEEK_END)) == 0:
+            return scan(np.zeros((0,), dtype=np.uint8))
+        profile_read(size)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return scan(np.frombuffer(m, dtype=np.uint8))
+
+def scan_keyframe_format(data: np.ndarray[np.uint8]) -> np.ndarray[int]:
+    # The first token of every line starting with a digit is a keyframe.
+    # Comment lines and the fps line never start with a digit.
+    starts = np.concatenate(([0], np.flatnonzero(data == 0x0A) + 1))
+    starts = starts[starts < data.shape[0]]
+    digit = (data >= 0x30) & (data <= 0x39)
+    starts = starts[digit[starts]]
+    nondigit = np.append(np.flatnonzero(~digit), data.shape[0])
+    ends = nondigit[np.searchsorted(nondigit, starts)]
+    valid = ends == data.shape[0]
+    valid[~valid] = np.isin(data[ends[~valid]], (0x09, 0x0A, 0x0D, 0x20))
+    starts = starts[valid]
+    lengths = ends[valid] - starts
+
+    keyframes = np.zeros(starts.shape, dtype=np.int64)
+    for i in range(lengths.max() if lengths.shape[0] else 0):
+        digits = lengths > i
+        keyframes[digits] = keyframes[digits] * 10 + (data[starts[digits] + i] - 0x30)
+    return keyframes
+
+def scan_lwi(data: np.ndarray[np.uint8]) -> np.ndarray[bool]:
+    # Find lines starting with "Key=" one 64 MiB chunk at a time so that
+    # temporary arrays stay small for index files of several hundred MB.
+    pattern = np.frombuffer(b"Key=", dtype=np.uint8)
+    keyframes = [np.zeros((0,), dtype=bool)]
+    for start in range(0, data.shape[0], 67108864):
+        chunk = data[start:start + 67108869]
+        lines = np.flatnonzero(chunk[:67108864] == 0x0A) + 1
+        if start == 0:
+            lines = np.concatenate(([0], lines))
+        lines = lines[lines + 4 < chunk.shape[0]]
+        match = np.ones(lines.shape, dtype=bool)
+        for i in range(4):
+            match &= chunk[lines + i] == pattern[i]
+        keyframes.append(chunk[lines[match] + 4] != 0x30)
+    return np.concatenate(keyframes)
+
+def get_keyframes_keyframe_format(path: Path) -> Keyframes:
+    with profile_stage("parse keyframe format", path=path.name):
+        return Keyframes(np.unique(map_file(path, scan_keyframe_format)).astype(np.int32), None)
+
+def get_keyframes_lwi(path: Path) -> Keyframes:
+    with profile_stage("parse lwi", path=path.name):
+        return pack_keyframes(map_file(path, scan_lwi))
+
+# Matroska and MP4 store keyframe positions in their headers. These
+# functions read them with a few seeks and small reads so that video
+# files don't need to be indexed by lsmas. They raise ValueError for
+# files they can't handle and get_keyframes_video falls back to lsmas.
+def read_ebml_vint(data: bytes, pos: int, mask: bool = True) -> tuple[int, int]:
+    if pos >= len(data) or data[pos] == 0:
+        raise ValueError("Invalid EBML variable size integer")
+    length = 9 - data[pos].bit_length()
+    if pos + length > len(data):
+        raise ValueError("Truncated EBML variable size integer")
+    value = data[pos] & (0xFF >> length) if mask else data[pos]
+    for byte in data[pos + 1:pos + length]:
+        value = value << 8 | byte
+    if mask and value == (1 << 7 * length) - 1:
+        value = -1
+    return value, pos + length
+
+# Yields (id, data start, data end) for each EBML element in data[pos:end].
+def iter_ebml_elements(data: bytes, pos: int = 0, end: typing.Optional[int] = None) -> typing.Iterator[tuple[int, int, int]]:
+    if end is None:
+        end = len(data)
+    while pos < end:
+        id, pos = read_ebml_vint(data, pos, mask=False)
+        size, pos = read_ebml_vint(data, pos)
+        if size == -1 or pos + size > end:
+            raise ValueError("Invalid EBML element size")
+        yield id, pos, pos + size
+        pos += size
+
+def read_ebml_header(f: typing.BinaryIO, pos: int) -> typing.Optional[tuple[int, int, int]]:
+    f.seek(pos)
+    data = f.read(12)
+    if not data:
+        return None
+    id, offset = read_ebml_vint(data, 0, mask=False)
+    size, offset = read_ebml_vint(data, offset)
+    return id, pos + offset, pos + offset + size if size != -1 else -1
+
+def read_ebml_uint(data: bytes) -> int:
+    return int.from_bytes(data, "big")
+
+def get_fps_fraction(fps: fractions.Fraction) -> tuple[int]:
+    fps = fps.limit_denominator(1001)
+    return fps.numerator, fps.denominator
+
+def get_keyframes_matroska(f: typing.BinaryIO) -> tuple[np.ndarray[bool], tuple[int]]:
+    header = read_ebml_header(f, 0)
+    if header is None or header[0] != 0x1A45DFA3 or header[2] == -1:
+        raise ValueError("Not a Matroska file")
+    f.seek(header[1])
+    data = f.read(header[2] - header[1])
+    for id, start, end in iter_ebml_elements(data):
+        if id == 0x4282 and data[start:end].rstrip(b"\0") not in (b"matroska", b"webm"):
+            raise ValueError("Not a Matroska file")
+    segment = read_ebml_header(f, header[2])
+    if segment is None or segment[0] != 0x18538067:
+        raise ValueError("Matroska segment not found")
+    segment_start = segment[1]
+    segment_end = segment[2] if segment[2] != -1 else f.seek(0, os.SEEK_END)
+
+    # Read top level elements until the first Cluster, and then jump to
+    # Info, Tracks and Cues using SeekHead if they were not found yet.
+    elements = {}
+    seeks = {}
+    cluster = None
+    pos = segment_start
+    while pos < segment_end:
+        if (header := read_ebml_header(f, pos)) is None or header[2] == -1:
+            break
+        id, start, end = header
+        if id == 0x1F43B675:
+            if cluster is None:
+                cluster = pos
+            if 0x1C53BB6B in seeks or 0x1C53BB6B in elements:
+                break
+        elif id in (0x114D9B74, 0x1549A966, 0x1654AE6B, 0x1C53BB6B):
+            f.seek(start)
+            elements[id] = f.read(end - start)
+            if id == 0x114D9B74:
+                for seek_id, seek_start, seek_end in iter_ebml_elements(elements[id]):
+                    if seek_id == 0x4DBB:
+                        entry = {}
+                        for entry_id, entry_start, entry_end in iter_ebml_elements(elements[id], seek_start, seek_end):
+                            entry[entry_id] = elements[id][entry_start:entry_end]
+                        if 0x53AB in entry and 0x53AC in entry:
+                            seeks[read_ebml_uint(entry[0x53AB])] = segment_start + read_ebml_uint(entry[0x53AC])
+        if 0x1549A966 in elements and 0x1654AE6B in elements and 0x1C53BB6B in elements:
             break
+        pos = end
+    for id in (0x1549A966, 0x1654AE6B, 0x1C53BB6B):
+        if id not in elements and id in seeks:
+            if (header := read_ebml_header(f, seeks[id])) is not None and header[0] == id and header[2] != -1:
+                f.seek(header[1])
+                elements[id] = f.read(header[2] - header[1])
+    if 0x1549A966 not in elements or 0x1654AE6B not in elements:
+        raise ValueError("Matroska Info or Tracks not found")
 
-        if line.startswith("#") or line.startswith("fps"):
-            continue
+    timestamp_scale = 1000000
+    duration = None
+    muxing_app = b""
+    for id, start, end in iter_ebml_elements(elements[0x1549A966]):
+        if id == 0x2AD7B1:
+            timestamp_scale = read_ebml_uint(elements[0x1549A966][start:end])
+        elif id == 0x4489:
+            duration = struct.unpack(">f" if end - start == 4 else ">d", elements[0x1549A966][start:end])[0]
+        elif id == 0x4D80:
+            muxing_app = elements[0x1549A966][start:end]
 
-        try:
-            lines.append(int(line.split()[0]))
-        except (IndexError, ValueError):
+    track = None
+    default_duration = None
+    for id, start, end in iter_ebml_elements(elements[0x1654AE6B]):
+        if id == 0xAE:
+            entry = {}
+            for entry_id, entry_start, entry_end in iter_ebml_elements(elements[0x1654AE6B], start, end):
+                entry[entry_id] = elements[0x1654AE6B][entry_start:entry_end]
+            if 0x83 in entry and read_ebml_uint(entry[0x83]) == 1 and 0xD7 in entry:
+                track = read_ebml_uint(entry[0xD7])
+                if 0x23E383 in entry:
+                    default_duration = read_ebml_uint(entry[0x23E383])
+                break
+    if track is None or not default_duration:
+        raise ValueError("Matroska video track with DefaultDuration not found")
+    fps = get_fps_fraction(fractions.Fraction(1000000000, default_duration))
+
+    # mkvmerge writes a CuePoint for every keyframe in video tracks by
+    # default. Other muxers such as Lavf may skip keyframes in Cues.
+    if 0x1C53BB6B in elements and duration is not None and muxing_app.startswith(b"libebml"):
+        times = []
+        for id, start, end in iter_ebml_elements(elements[0x1C53BB6B]):
+            if id == 0xBB:
+                time = None
+                video = False
+                for point_id, point_start, point_end in iter_ebml_elements(elements[0x1C53BB6B], start, end):
+                    if point_id == 0xB3:
+                        time = read_ebml_uint(elements[0x1C53BB6B][point_start:point_end])
+                    elif point_id == 0xB7:
+                        for position_id, position_start, position_end in iter_ebml_elements(elements[0x1C53BB6B], point_start, point_end):
+                            if position_id == 0xF7 and read_ebml_uint(elements[0x1C53BB6B][position_start:position_end]) == track:
+                                video = True
+                if video and time is not None:
+                    times.append(time)
+        if len(times) >= 2:
+            times = np.array(times, dtype=np.float64)
+            frames = np.rint((times - times.min()) * timestamp_scale / default_duration).astype(np.int64)
+            keyframes = np.zeros((int(round(duration * timestamp_scale / default_duration)),), dtype=bool)
+            keyframes[frames[frames < keyframes.shape[0]]] = True
+            return keyframes, fps
+
+    # Without complete Cues, read the header of every block in every Cluster
+    # while skipping over the frame data.
+    if cluster is None:
+        raise ValueError("Matroska Cluster not found")
+    times = []
+    keys = []
+    pos = cluster
+    while pos < segment_end:
+        if (header := read_ebml_header(f, pos)) is None:
+            break
+        id, start, end = header
+        if end == -1:
+            raise ValueError("Matroska Cluster with unknown size")
+        if id == 0x1F43B675:
+            cluster_time = 0
+            block_pos = start
+            while block_pos < end:
+                if (header := read_ebml_header(f, block_pos)) is None or header[2] == -1:
+                    raise ValueError("Truncated Matroska Cluster")
+                block_id, block_start, block_end = header
+                if block_id == 0xE7:
+                    f.seek(block_start)
+                    cluster_time = read_ebml_uint(f.read(block_end - block_start))
+                elif block_id == 0xA3 or block_id == 0xA0:
+                    # A Block in a BlockGroup is a keyframe if the group
+                    # has no ReferenceBlock.
+                    key = True
+                    block = None
+                    if block_id == 0xA3:
+                        block = block_start
+                    else:
+                        group_pos = block_start
+                        while group_pos < block_end:
+                            if (header := read_ebml_header(f, group_pos)) is None or header[2] == -1:
+                                raise ValueError("Truncated Matroska BlockGroup")
+                            group_id, group_start, group_end = header
+                            if group_id == 0xA1:
+                                block = group_start
+                            elif group_id == 0xFB:
+                                key = False
+                            group_pos = group_end
+                    if block is not None:
+                        f.seek(block)
+                        data = f.read(12)
+                        block_track, offset = read_ebml_vint(data, 0)
+                        if block_track == track:
+                            times.append(cluster_time + struct.unpack(">h", data[offset:offset + 2])[0])
+                            if block_id == 0xA3:
+                                keys.append(bool(data[offset + 2] & 0x80))
+                            else:
+                                keys.append(key)
+                block_pos = block_end
+        pos = end
+    if not times:
+        raise ValueError("Matroska video blocks not found")
+    return np.array(keys, dtype=bool)[np.argsort(np.array(times), kind="stable")], fps
+
+# Yields (type, data start, data end) for each MP4 box in data[pos:end].
+def iter_mp4_boxes(data: bytes, pos: int = 0, end: typing.Optional[int] = None) -> typing.Iterator[tuple[bytes, int, int]]:
+    if end is None:
+        end = len(data)
+    while pos + 8 <= end:
+        size, type = struct.unpack(">I4s", data[pos:pos + 8])
+        offset = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+            offset = 16
+        elif size == 0:
+            size = end - pos
+        if size < offset or pos + size > end:
+            raise ValueError("Invalid MP4 box size")
+        yield type, pos + offset, pos + size
+        pos += size
+
+def find_mp4_box(data: bytes, path: list[bytes], pos: int = 0, end: typing.Optional[int] = None) -> typing.Optional[tuple[int, int]]:
+    for type, start, box_end in iter_mp4_boxes(data, pos, end):
+        if type == path[0]:
+            if len(path) == 1:
+                return start, box_end
+            else:
+                return find_mp4_box(data, path[1:], start, box_end)
+    return None
+
+def get_keyframes_mp4(f: typing.BinaryIO) -> tuple[np.ndarray[bool], tuple[int]]:
+    # Find moov at the top level while seeking over mdat.
+    size = f.seek(0, os.SEEK_END)
+    pos = 0
+    moov = None
+    while pos + 8 <= size:
+        f.seek(pos)
+        header = f.read(16)
+        box_size, type = struct.unpack(">I4s", header[:8])
+        if box_size == 1:
+            box_size = struct.unpack(">Q", header[8:16])[0]
+        elif box_size == 0:
+            box_size = size - pos
+        if box_size < 8:
+            raise ValueError("Invalid MP4 box size")
+        if pos == 0 and type != b"ftyp":
+            raise ValueError("Not an MP4 file")
+        if type == b"moov":
+            f.seek(pos)
+            moov = f.read(box_size)
+            moov_start = 16 if struct.unpack(">I", header[:4])[0] == 1 else 8
+            break
+        pos += box_size
+    if moov is None:
+        raise ValueError("MP4 moov not found")
+
+    for type, start, end in iter_mp4_boxes(moov, moov_start):
+        if type != b"trak":
+            continue
+        if (mdia := find_mp4_box(moov, [b"mdia"], start, end)) is None or \
+           (hdlr := find_mp4_box(moov, [b"hdlr"], *mdia)) is None or \
+           moov[hdlr[0] + 8:hdlr[0] + 12] != b"vide":
             continue
 
-    return lines
+        mdhd = find_mp4_box(moov, [b"mdhd"], *mdia)
+        stbl = find_mp4_box(moov, [b"minf", b"stbl"], *mdia)
+        if mdhd is None or stbl is None:
+            raise ValueError("MP4 mdhd or stbl not found")
+        if moov[mdhd[0]] == 1:
+            timescale = struct.unpack(">I", moov[mdhd[0] + 20:mdhd[0] + 24])[0]
+        else:
+            timescale = struct.unpack(">I", moov[mdhd[0] + 12:mdhd[0] + 16])[0]
+
+        stsz = find_mp4_box(moov, [b"stsz"], *stbl)
+        stts = find_mp4_box(moov, [b"stts"], *stbl)
+        if stsz is None or stts is None:
+            raise ValueError("MP4 stsz or stts not found")
+        sample_count = struct.unpack(">I", moov[stsz[0] + 8:stsz[0] + 12])[0]
+        if sample_count == 0:
+            raise ValueError("MP4 video track has no samples, possibly fragmented")
+
+        entries = struct.unpack(">I", moov[stts[0] + 4:stts[0] + 8])[0]
+        table = np.frombuffer(moov, dtype=">u4", count=entries * 2, offset=stts[0] + 8).reshape((-1, 2)).astype(np.int64)
+        deltas = np.repeat(table[:, 1], table[:, 0])[:sample_count]
+        times = np.concatenate(([0], np.cumsum(deltas)[:-1]))
+        if (ctts := find_mp4_box(moov, [b"ctts"], *stbl)) is not None:
+            entries = struct.unpack(">I", moov[ctts[0] + 4:ctts[0] + 8])[0]
+            table = np.frombuffer(moov, dtype=">i4", count=entries * 2, offset=ctts[0] + 8).reshape((-1, 2)).astype(np.int64)
+            offsets = np.repeat(table[:, 1], table[:, 0].clip(min=0))[:sample_count]
+            times[:offsets.shape[0]] += offsets
+        if deltas.shape[0] == 0 or timescale == 0:
+            raise ValueError("MP4 frame rate not found")
+        values, counts = np.unique(deltas, return_counts=True)
+        if (delta := values[counts.argmax()]) == 0:
+            raise ValueError("MP4 frame rate not found")
+        fps = get_fps_fraction(fractions.Fraction(timescale, int(delta)))
+
+        # Samples are stored in decoding order. Convert sync sample numbers
+        # to their positions in presentation order.
+        order = np.empty((sample_count,), dtype=np.int64)
+        order[np.argsort(times, kind="stable")] = np.arange(sample_count)
+        keyframes = np.zeros((sample_count,), dtype=bool)
+        if (stss := find_mp4_box(moov, [b"stss"], *stbl)) is not None:
+            entries = struct.unpack(">I", moov[stss[0] + 4:stss[0] + 8])[0]
+            samples = np.frombuffer(moov, dtype=">u4", count=entries, offset=stss[0] + 8).astype(np.int64) - 1
+            keyframes[order[samples[samples < sample_count]]] = True
+        else:
+            keyframes[:] = True
+        return keyframes, fps
+
+    raise ValueError("MP4 video track not found")
+
+def get_keyframes_container(clip: Path) -> typing.Optional[Keyframes]:
+    global fps_num
+    global fps_den
+
+    try:
+        with open_file(clip) as f:
+            magic = f.read(12)
+            if magic[:4] == b"\x1A\x45\xDF\xA3":
+                keyframes, fps = get_keyframes_matroska(f)
+            elif magic[4:8] == b"ftyp":
+                keyframes, fps = get_keyframes_mp4(f)
+            else:
+                return None
+    except (ValueError, IndexError, struct.error, OSError):
+        return None
+    if keyframes.shape[0] == 0 or not keyframes[0]:
+        return None
+
+    fps_num, fps_den = fps
+    return pack_keyframes(keyframes)
+
+cache_dir = None
+cache_hash = False
+cache_size = 268435456
+cache_tmp_age = 3600
+force_lsmas = False
+
+def get_default_cache_dir() -> Path:
+    if platform.system() == "Windows" and "LOCALAPPDATA" in os.environ:
+        return Path(os.environ["LOCALAPPDATA"]).joinpath("TimingOffset")
+    elif "XDG_CACHE_HOME" in os.environ:
+        return Path(os.environ["XDG_CACHE_HOME"]).joinpath("TimingOffset")
+    else:
+        return Path.home().joinpath(".cache", "TimingOffset")
+
+# The cache key is the file's path, size and mtime. With cache_hash, the
+# key is instead the file's size and a hash of its first and last 4 MiB
+# so that cached entries survive the file being moved or renamed.
+def get_cache_key(clip: Path) -> str:
+    size, mtime_ns = get_file_stat(clip)
+    hash = hashlib.sha1()
+    if cache_hash:
+        hash.update(f"{size}\0".encode())
+        with open_file(clip) as f:
+            hash.update(f.read(4194304))
+            if size > 8388608:
+                f.seek(-4194304, os.SEEK_END)
+                hash.update(f.read(4194304))
+    else:
+        hash.update(f"{resolve_file(clip).as_posix()}\0{size}\0{mtime_ns}".encode())
+    return hash.hexdigest()
+
+def load_keyframes_cache(key: str) -> typing.Optional[Keyframes]:
+    global fps_num
+    global fps_den
 
-def get_keyframes_lwi(f: typing.TextIO) -> np.ndarray[bool]:
-    lines = []
-    while True:
+    cachefile = cache_dir.joinpath(key + ".npz")
+    if not cachefile.is_file():
+        return None
+    try:
+        with np.load(cachefile) as data:
+            keyframes = Keyframes(data["frames"].astype(np.int32), int(data["length"]))
+            fps = data["fps"]
+    except Exception:
+        return None
+    try:
+        os.utime(cachefile)
+    except OSError:
+        pass
+
+    if fps[0] != 0 and fps[1] != 0:
+        fps_num = int(fps[0])
+        fps_den = int(fps[1])
+    return keyframes
+
+def save_keyframes_cache(key: str, keyframes: Keyframes, fps: tuple[int]) -> None:
+    try:
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=cache_dir, prefix=key, suffix=".tmp", delete=False) as f:
+            np.savez(f, frames=keyframes.frames, length=keyframes.length, fps=np.array(fps, dtype=np.int64))
+        os.replace(f.name, cache_dir.joinpath(key + ".npz"))
+    except OSError:
+        return
+    evict_cache()
+
+# Evict least recently used entries until the cache fits in cache_size.
+# Temporary files older than cache_tmp_age were left behind by killed writers
+# and are removed, newer ones are still being written and only counted.
+def evict_cache() -> None:
+    entries = []
+    writing = 0
+    now = time.time()
+    for entry in os.scandir(cache_dir):
+        if not entry.name.endswith((".npz", ".scenes.txt", ".tmp")):
+            continue
         try:
-            line = f.readline()
-        except UnicodeDecodeError:
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+        except OSError:
             continue
-        if not line:
+        if entry.name.endswith(".tmp"):
+            if now - stat.st_mtime <= cache_tmp_age:
+                writing += stat.st_size
+                continue
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = writing + sum(entry[1] for entry in entries)
+    for _, size, path in sorted(entries):
+        if total <= cache_size:
             break
-        
-        if line.startswith("Key="):
-            lines.append(bool(int(line[4])))
-        else:
+        try:
+            os.remove(path)
+        except OSError:
             continue
+        total -= size
 
-    return np.array(lines, dtype=bool)
+# Worker processes for --jobs have their stderr silenced, so they keep
+# their warnings in worker_warnings to be printed by the main process.
+worker_warnings = None
 
-def get_keyframes_video(clip: Path) -> np.ndarray[bool]:
+def print_warning(message: str) -> None:
+    if worker_warnings is not None:
+        worker_warnings.append(message)
+    else:
+        print(message, file=sys.stderr)
+
+def get_keyframes_video(clip: Path) -> Keyframes:
+    if scene_change == "always":
+        return get_keyframes_scenes(clip)
+
+    keyframes = get_keyframes_encoded(clip)
+    if scene_change == "auto" and is_fixed_gop(keyframes):
+        if get_scene_frames_source() is not None:
+            print_warning(f"\033[33mKeyframes in \033[0m\"{clip.name}\"\033[33m are placed at a fixed interval. Detecting scene changes instead...\033[0m")
+            return get_keyframes_scenes(clip)
+        print_warning(f"\033[33mKeyframes in \033[0m\"{clip.name}\"\033[33m are placed at a fixed interval. Install VapourSynth with lsmas or {scene_change_command[0]} to detect scene changes instead.\033[0m")
+    return keyframes
+
+def get_keyframes_encoded(clip: Path) -> Keyframes:
+    if not force_lsmas:
+        with profile_stage("container", path=clip.name):
+            keyframes = get_keyframes_container(clip)
+        if keyframes is not None:
+            return keyframes
+
+    if cache_dir is None:
+        return get_keyframes_lsmas(clip)
+
+    with profile_stage("cache", path=clip.name):
+        key = get_cache_key(clip)
+        keyframes = load_keyframes_cache(key)
+    if keyframes is not None:
+        return keyframes
+    keyframes = get_keyframes_lsmas(clip)
+    save_keyframes_cache(key, keyframes, (fps_num, fps_den))
+    return keyframes
+
+def get_keyframes_lsmas(clip: Path) -> Keyframes:
     from vapoursynth import core
 
     global fps_num
     global fps_den
 
-    with tempfile.TemporaryDirectory(prefix="TimingOffset") as cache:
+    with tempfile.TemporaryDirectory(prefix="TimingOffset") as cache, profile_stage("lsmas", path=clip.name):
+        # lsmas reads the whole file to index it.
+        profile_read(get_file_stat(clip)[0])
         cachefile = Path(cache).joinpath("TimingOffset.lwi")
         clip = core.lsmas.LWLibavSource(clip.as_posix(), cache=True, cachefile=cachefile.as_posix())
         print("\r\033[1A\033[K", end="", file=sys.stderr)
@@ -101,113 +712,626 @@ def get_keyframes_video(clip: Path) -> np.ndarray[bool]:
             fps_num = clip.fps.numerator
             fps_den = clip.fps.denominator
         
+        return get_keyframes_lwi(cachefile)
+
+# Most sources from streaming platforms place a keyframe every few
+# seconds regardless of the content. Their keyframes carry no information
+# about scene changes, so the clip is treated as fixed GOP if most of the
+# intervals between its keyframes are the same.
+def is_fixed_gop(keyframes: Keyframes) -> bool:
+    intervals = np.diff(keyframes.frames)[:-1]
+    if intervals.shape[0] < 16:
+        return False
+    return np.bincount(intervals).max() > intervals.shape[0] * 0.8
+
+# Scene change detection for fixed GOP sources. Frames are downscaled to
+# scene_size in grey, either by VapourSynth with lsmas or by the
+# scene_change_command pipe, and compared in blocks of 256 frames.
+scene_change = "auto"
+scene_size = (64, 36)
+scene_change_command = ["ffmpeg", "-v", "error", "-nostdin", "-i", "{input}", "-map", "0:v:0", "-vf", "scale={width}:{height}:flags=area,format=gray", "-f", "rawvideo", "-"]
+
+def get_scene_frames_source() -> typing.Optional[typing.Callable[[Path], typing.Iterator[np.ndarray[np.uint8]]]]:
+    if importlib.util.find_spec("vapoursynth") is not None:
+        return iter_scene_frames_vapoursynth
+    elif shutil.which(scene_change_command[0]) is not None:
+        return iter_scene_frames_pipe
+    else:
+        return None
+
+def iter_scene_frames_vapoursynth(clip: Path) -> typing.Iterator[np.ndarray[np.uint8]]:
+    import vapoursynth as vs
+    from vapoursynth import core
+
+    global fps_num
+    global fps_den
+
+    with tempfile.TemporaryDirectory(prefix="TimingOffset") as cache:
+        src = core.lsmas.LWLibavSource(clip.as_posix(), cache=True, cachefile=Path(cache).joinpath("TimingOffset.lwi").as_posix())
+        print("\r\033[1A\033[K", end="", file=sys.stderr)
+        if src.fps.numerator != 0 and src.fps.denominator != 0:
+            fps_num = src.fps.numerator
+            fps_den = src.fps.denominator
+        small = core.resize.Bilinear(src, scene_size[0], scene_size[1], format=vs.GRAY8)
+
+        # frames() keeps requests for the following frames in flight on
+        # VapourSynth's thread pool while the current one is copied.
+        block = np.empty((256, scene_size[1], scene_size[0]), dtype=np.uint8)
+        count = 0
+        for frame in small.frames():
+            block[count % 256] = np.asarray(frame[0])
+            count += 1
+            if count % 256 == 0:
+                yield block.copy()
+        if count % 256 != 0:
+            yield block[:count % 256].copy()
+
+def iter_scene_frames_pipe(clip: Path) -> typing.Iterator[np.ndarray[np.uint8]]:
+    command = [argument.format(input=clip.as_posix(), width=scene_size[0], height=scene_size[1]) for argument in scene_change_command]
+    frame_size = scene_size[0] * scene_size[1]
+    with subprocess.Popen(command, stdout=subprocess.PIPE) as process:
+        while data := process.stdout.read(frame_size * 256):
+            yield np.frombuffer(data[:len(data) - len(data) % frame_size], dtype=np.uint8).reshape((-1, scene_size[1], scene_size[0]))
+    if process.returncode != 0:
+        raise ValueError(f"\"{' '.join(command)}\" exited with code {process.returncode}.")
+
+# diffs[i] is the mean absolute difference between frame i and frame i - 1,
+# with diffs[0] being 0. A frame is a scene change if its difference is
+# well above the median of the 25 frames around it, is the largest within
+# 3 frames, and is half again as large as any other difference in the 25
+# frames apart from its direct neighbours. The last condition keeps
+# animation on twos or threes, where every second or third frame moves,
+# from being taken as a series of scene changes.
+def detect_scene_changes(diffs: np.ndarray[np.float32]) -> np.ndarray[bool]:
+    windows = sliding_window_view(np.pad(diffs, 12, mode="edge"), 25)
+    local = np.median(windows, axis=1)
+    peak = windows[:, 9:16].max(axis=1)
+    other = np.maximum(windows[:, :11].max(axis=1), windows[:, 14:].max(axis=1))
+    keyframes = (diffs > local * 3 + 4) & (diffs >= peak) & (diffs > other * 1.5)
+    if keyframes.shape[0]:
+        keyframes[0] = True
+    return keyframes
+
+def get_keyframes_scenes(clip: Path) -> Keyframes:
+    if cache_dir is not None:
+        key = get_cache_key(clip)
+        if (keyframes := load_scenes_cache(key)) is not None:
+            return keyframes
+
+    with profile_stage("scene change", path=clip.name):
+        profile_read(get_file_stat(clip)[0])
+        if (source := get_scene_frames_source()) is None:
+            raise ValueError(f"Scene change detection on \"{clip.name}\" requires either VapourSynth with lsmas or {scene_change_command[0]}.")
+        blocks = source(clip)
+
+        diffs = []
+        previous = None
+        for block in blocks:
+            block = block.astype(np.int16)
+            if previous is None:
+                diffs.append(np.zeros((1,), dtype=np.float32))
+            else:
+                diffs.append(np.abs(block[:1] - previous).mean(axis=(1, 2), dtype=np.float32))
+            diffs.append(np.abs(block[1:] - block[:-1]).mean(axis=(1, 2), dtype=np.float32))
+            previous = block[-1:]
+        if previous is None:
+            raise ValueError(f"No frames could be decoded from \"{clip.name}\".")
+        keyframes = pack_keyframes(detect_scene_changes(np.concatenate(diffs)))
+
+    if cache_dir is not None:
+        save_scenes_cache(key, keyframes)
+    return keyframes
+
+# Detected scene changes are cached as keyframe format files, with the
+# number of frames in a comment since the format doesn't record it.
+def load_scenes_cache(key: str) -> typing.Optional[Keyframes]:
+    cachefile = cache_dir.joinpath(key + ".scenes.txt")
+    try:
         with cachefile.open("r", encoding="utf-8") as f:
-            return get_keyframes_lwi(f)
+            header = f.read(64)
+        length = int(re.search(r"^# frames ([0-9]+)$", header, re.MULTILINE).group(1))
+        keyframes = get_keyframes_keyframe_format(cachefile)._replace(length=length)
+        os.utime(cachefile)
+    except (OSError, AttributeError, ValueError):
+        return None
+    return keyframes
 
-def guess_filetype(path: Path) -> str:
-    if path.stat().st_size > 16777216:
-        return "binary"
-    f = path.open("r", encoding="utf-8")
+def save_scenes_cache(key: str, keyframes: Keyframes) -> None:
     try:
-        line = f.readline()
-        if line.startswith("# keyframe format") or line.startswith("fps"):
-            f.close()
-            return "keyframe_format"
-        elif line.startswith("<LSMASHWorksIndexVersion"):
-            f.close()
-            return "lwi"
-        else:
-            f.close()
-            return "binary"
-    except UnicodeDecodeError:
-        f.close()
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=cache_dir, prefix=key, suffix=".tmp", delete=False) as f:
+            f.write(f"# keyframe format v1\nfps 0\n# frames {keyframes.length}\n")
+            f.write("".join(f"{frame}\n" for frame in keyframes.frames))
+        os.replace(f.name, cache_dir.joinpath(key + ".scenes.txt"))
+    except OSError:
+        return
+    evict_cache()
+
+def sniff_filetype(line: bytes) -> str:
+    if line.startswith(b"# keyframe format") or line.startswith(b"fps"):
+        return "keyframe_format"
+    elif line.startswith(b"<LSMASHWorksIndexVersion"):
+        return "lwi"
+    else:
         return "binary"
 
-def get_keyframes(clip: Path) -> typing.Union[list[int], np.ndarray[bool]]:
-    if clip.stat().st_size > 16777216:
-        return get_keyframes_video(clip)
-    f = clip.open("r", encoding="utf-8")
-    try:
-        line = f.readline()
-        if line.startswith("# keyframe format") or line.startswith("fps"):
-            result = get_keyframes_keyframe_format(f)
-            f.close()
-            return result
-        elif line.startswith("<LSMASHWorksIndexVersion"):
-            result = get_keyframes_lwi(f)
-            f.close()
-            return result
+# A file found by scan_directory, with everything later stages would
+# otherwise open or stat it again for.
+class ScannedFile(typing.NamedTuple):
+    resolved: Path
+    filetype: str
+    size: int
+    mtime_ns: int
+
+# Files found in the current run. Watch mode clears it before each scan and
+# the library API before each call, so that files changed in the meantime
+# are scanned again.
+scanned_files = {}
+scan_threads = 16
+
+def scan_file(entry: os.DirEntry, directory: Path) -> ScannedFile:
+    with open(entry.path, "rb", buffering=0) as f:
+        line = f.read(24)
+        stat = os.fstat(f.fileno())
+    resolved = Path(entry.path).resolve() if entry.is_symlink() else directory.joinpath(entry.name)
+    return ScannedFile(resolved, sniff_filetype(line), stat.st_size, stat.st_mtime_ns)
+
+# Lists the files in path with os.scandir, then opens each file once in a
+# thread pool to sniff its type and stat it. On network shares, where
+# every open and stat is a round trip, this keeps the round trips in
+# flight together instead of one after another. Only files whose names
+# pass filter are sniffed. The results are kept in scanned_files for
+# guess_filetype, get_file_stat and resolve_file.
+def scan_directory(path: Path, filter: typing.Optional[typing.Callable[[str], typing.Any]] = None) -> dict[Path, ScannedFile]:
+    with os.scandir(path) as iterator:
+        entries = sorted((entry for entry in iterator if entry.is_file() and (filter is None or filter(entry.name))), key=lambda entry: entry.name)
+    directory = path.resolve()
+
+    with profile_stage("scan directory", path=path.name, files=len(entries)):
+        if len(entries) > 1:
+            with ThreadPoolExecutor(max_workers=min(scan_threads, len(entries))) as executor:
+                files = list(executor.map(lambda entry: scan_file(entry, directory), entries))
+        else:
+            files = [scan_file(entry, directory) for entry in entries]
+        profile_read(24 * len(files))
+
+    files = {Path(entry.path): file for entry, file in zip(entries, files)}
+    scanned_files.update(files)
+    return files
+
+def get_file_stat(path: Path) -> tuple[int, int]:
+    if (scanned := scanned_files.get(path)) is not None:
+        return scanned.size, scanned.mtime_ns
+    stat = path.stat()
+    return stat.st_size, stat.st_mtime_ns
+
+def resolve_file(path: Path) -> Path:
+    if (scanned := scanned_files.get(path)) is not None:
+        return scanned.resolved
+    return path.resolve()
+
+def guess_filetype(path: Path) -> str:
+    if (scanned := scanned_files.get(path)) is not None:
+        return scanned.filetype
+    with profile_stage("sniff", path=path.name), open_file(path) as f:
+        line = f.read(24)
+    return sniff_filetype(line)
+
+def get_keyframes(clip: Path) -> Keyframes:
+    with profile_stage("keyframes", path=clip.name):
+        filetype = guess_filetype(clip)
+        if filetype == "keyframe_format":
+            return get_keyframes_keyframe_format(clip)
+        elif filetype == "lwi":
+            return get_keyframes_lwi(clip)
         else:
-            f.close()
             return get_keyframes_video(clip)
-    except UnicodeDecodeError:
-        f.close()
-        return get_keyframes_video(clip)
-
-def inflate_keyframes_array(left: typing.Union[list[int], np.ndarray[bool]], right: typing.Union[list[int], np.ndarray[bool]]) -> tuple[np.ndarray[bool], np.ndarray[bool]]:
-    left_type = isinstance(left, np.ndarray)
-    right_type = isinstance(right, np.ndarray)
-    if left_type and right_type:
-        return left, right
-    elif left_type and (not right_type):
-        new_right = np.zeros_like(left)
-        for n in right:
-            new_right[n] = True
-        return left, new_right
-    elif (not left_type) and right_type:
-        new_left = np.zeros_like(right)
-        for n in left:
-            new_left[n] = True
-        return new_left, right
+
+# Keyframe format files don't record the number of frames in the clip.
+# Assume it to be the same as the other clip's.
+def complete_keyframes_length(left: Keyframes, right: Keyframes) -> tuple[Keyframes, Keyframes]:
+    if left.length is None and right.length is None:
+        length = int(max(left.frames[-1] + 1, right.frames[-1] + 1))
+        return left._replace(length=length), right._replace(length=length)
+    elif left.length is None:
+        return Keyframes(left.frames[left.frames < right.length], right.length), right
+    elif right.length is None:
+        return left, Keyframes(right.frames[right.frames < left.length], left.length)
     else:
-        new_left = np.zeros(max(left[-1] + 1, right[-1] + 1), dtype=bool)
-        new_right = np.zeros_like(new_left)
-        for n in left:
-            new_left[n] = True
-        for n in right:
-            new_right[n] = True
-        return new_left, new_right
+        return left, right
 
 this_is_likely_due_to = True
+max_offset = 240
+# Keyframes up to tolerance frames apart are counted as matching, for
+# encoders that place keyframes a frame or two off the scene cut.
+tolerance = 0
+
+# Returns every frame i in range_ and offset s within radius of center
+# where both left[i] and right[i + s] are keyframes. Every pair of left
+# and right keyframes is found with a sorted search, so the cost depends
+# only on the number of keyframes and not on the number of frames.
+def match_keyframes(left: Keyframes, right: Keyframes, range_: tuple[int], radius: int = 240, center: int = 0) -> tuple[np.ndarray[int], np.ndarray[int]]:
+    left_frames = left.frames[np.searchsorted(left.frames, range_[0]):np.searchsorted(left.frames, range_[1])]
+    lo = np.searchsorted(right.frames, left_frames + center - radius, side="left")
+    hi = np.searchsorted(right.frames, left_frames + center + radius, side="right")
+    counts = hi - lo
+    pairs = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    frames = np.repeat(left_frames, counts)
+    return frames, right.frames[pairs] - frames
 
 # Caller must assure that range was valid for both left and right array.
-def guess_offset_range(left: np.ndarray[bool], right: np.ndarray[bool], range_: tuple[int]) -> typing.Optional[str]:
-    global this_is_likely_due_to
+# results[radius + s] is the number of frames i in range_ where both
+# left[i] and right[i + center + s] are keyframes.
+def correlate_keyframes(left: Keyframes, right: Keyframes, range_: tuple[int], radius: int = 240, center: int = 0) -> np.ndarray[int]:
+    _, offsets = match_keyframes(left, right, range_, radius, center)
+    return np.bincount(offsets - center + radius, minlength=2 * radius + 1)
+
+# Counting exact matches for every offset up to max_offset would take time
+# proportional to max_offset. Instead, correlate the number of keyframes
+# in bins of width frames to find the strongest candidates, and only count
+# exact matches for offsets around these candidates.
+def find_wide_offset_candidates(left: Keyframes, right: Keyframes, range_: tuple[int]) -> tuple[list[int], int]:
+    width = max(max_offset // 256, 4)
+    start = range_[0] - max_offset
+    left_frames = left.frames[np.searchsorted(left.frames, range_[0]):np.searchsorted(left.frames, range_[1])]
+    right_frames = right.frames[np.searchsorted(right.frames, start):np.searchsorted(right.frames, range_[1] + max_offset)]
+    left_bins = np.bincount((left_frames - range_[0]) // width, minlength=-(-(range_[1] - range_[0]) // width))
+    right_bins = np.bincount((right_frames - start) // width, minlength=-(-(range_[1] + max_offset - start) // width))
+
+    # Lag k of the binned correlation holds offsets within width frames of
+    # k * width - max_offset.
+    n = 1 << (right_bins.shape[0] - 1).bit_length()
+    spectrum = np.conj(np.fft.rfft(left_bins.astype(np.float64), n)) * np.fft.rfft(right_bins.astype(np.float64), n)
+    coarse = np.fft.irfft(spectrum, n)[:right_bins.shape[0] - left_bins.shape[0] + 1]
+    return [int(lag) * width - max_offset for lag in np.argsort(coarse, kind="stable")[-8:]], width
+
+def search_wide_offset_range(left: Keyframes, right: Keyframes, range_: tuple[int], exclude: int) -> tuple[np.ndarray[int], np.ndarray[int]]:
+    centers, width = find_wide_offset_candidates(left, right, range_)
+    results = {}
+    for center in centers:
+        for offset, result in enumerate(correlate_keyframes(left, right, range_, width + tolerance, center), start=center - width - tolerance):
+            if exclude < abs(offset) <= max_offset + tolerance:
+                results[offset] = result
+    offsets = np.array(sorted(results), dtype=int)
+    return offsets, np.array([results[offset] for offset in offsets], dtype=int)
+
+# Dilates counts along its first axis, so that counts[i] becomes the
+# number of matches at any offset within tolerance frames of offsets[i].
+# offsets must be sorted. Each dilated count is the difference between two
+# cumulative counts, found with a binary search.
+def dilate_counts(offsets: np.ndarray[int], counts: np.ndarray[int]) -> np.ndarray[int]:
+    lo = np.searchsorted(offsets, offsets - tolerance, side="left")
+    hi = np.searchsorted(offsets, offsets + tolerance, side="right")
+    cumulative = np.concatenate((np.zeros((1,) + counts.shape[1:], dtype=counts.dtype), np.cumsum(counts, axis=0)))
+    return cumulative[hi] - cumulative[lo]
+
+# An offset and its unit variance against all other offsets searched.
+# With a tolerance, centroid is the mean offset of the matches counted,
+# which lands between frames when the keyframes jitter to one side, and
+# exact is the share of these matches that are exactly at offset.
+class Offset(typing.NamedTuple):
+    offset: int
+    unit_variance: float
+    centroid: typing.Optional[float] = None
+    exact: typing.Optional[float] = None
+
+# Returns the Offset at each of indices, where exact is the count of
+# exact matches at each of offsets. With a tolerance, the dilated counts
+# of neighbouring offsets share their matches and form a plateau, so only
+# the offset with the highest unit variance within 2 * tolerance frames is
+# kept, and it is moved twice to the offset nearest to the centroid of
+# the matches within tolerance frames.
+def describe_offsets(indices: np.ndarray[int], offsets: np.ndarray[int], unit_variances: np.ndarray[float], exact: np.ndarray[int]) -> list[Offset]:
+    if tolerance == 0:
+        return [Offset(int(offsets[index]), float(unit_variances[index])) for index in indices]
+
+    kept = np.zeros(indices.shape, dtype=bool)
+    for i in np.lexsort((exact[indices], unit_variances[indices]))[::-1]:
+        kept[i] = not np.any(kept & (np.abs(offsets[indices] - offsets[indices[i]]) <= 2 * tolerance))
+    indices = indices[kept]
+
+    cumulative = np.concatenate(([0], np.cumsum(exact)))
+    weighted = np.concatenate(([0], np.cumsum(exact * offsets)))
+    for step in range(3):
+        lo = np.searchsorted(offsets, offsets[indices] - tolerance, side="left")
+        hi = np.searchsorted(offsets, offsets[indices] + tolerance, side="right")
+        totals = np.maximum(cumulative[hi] - cumulative[lo], 1)
+        centroids = (weighted[hi] - weighted[lo]) / totals
+        if step < 2:
+            moved = np.minimum(np.searchsorted(offsets, np.round(centroids)), offsets.shape[0] - 1)
+            indices = np.where(np.isfinite(unit_variances[moved]), moved, indices)
+    return [Offset(int(offsets[index]), float(unit_variances[index]), float(centroid), float(exact[index] / total))
+            for index, centroid, total in zip(indices, centroids, totals)]
 
-    results = np.empty((481,), dtype=int)
-    for iter in range(-240, 0):
-        rl = max(range_[0] + iter, 0)
-        rr = range_[1] + iter
-        ll = range_[1] - (rr - rl)
-        lr = range_[1]
-        results[iter + 240] = np.count_nonzero(np.logical_and(left[ll:lr], right[rl:rr]))
-    for iter in range(0, 241):
-        rl = range_[0] + iter
-        rr = min(range_[1] + iter, right.shape[0])
-        ll = range_[0]
-        lr = range_[0] + (rr - rl)
-        results[iter + 240] = np.count_nonzero(np.logical_and(left[ll:lr], right[rl:rr]))
+# offsets are the significant offsets between frame start and end. If
+# there is none, candidates are the offsets with high unit variance.
+class Section(typing.NamedTuple):
+    start: int
+    end: int
+    offsets: list[Offset]
+    candidates: list[Offset]
+
+class Segment(typing.NamedTuple):
+    start: int
+    end: int
+    offset: int
+
+# How well a target aligns with the reference over its whole length.
+# offsets are the significant offsets, strongest first, and matched is the
+# share of the reference's keyframes that the strongest offset matches.
+class Alignment(typing.NamedTuple):
+    length: int
+    offsets: list[Offset]
+    matched: float
+
+# Caller must assure that range was valid for both left and right array.
+def analyse_offset_range(left: Keyframes, right: Keyframes, range_: tuple[int]) -> Section:
+    # Exact counts are always taken for every offset within 240 frames so
+    # that the unit variance has enough offsets to be measured against,
+    # even if max_offset is smaller. The offsets beyond max_offset are
+    # measured but never picked. With a tolerance, exact counts are taken
+    # for tolerance more frames on each side so that the dilated counts at
+    # the edges are complete, and these extra offsets are left out of the
+    # unit variance.
+    radius = 240
+    results = correlate_keyframes(left, right, range_, radius + tolerance)
+    offsets = np.arange(-radius - tolerance, radius + tolerance + 1)
+    if max_offset > radius:
+        wide_offsets, wide_results = search_wide_offset_range(left, right, range_, radius + tolerance)
+        offsets = np.concatenate((offsets, wide_offsets))
+        results = np.concatenate((results, wide_results))
+        order = np.argsort(offsets, kind="stable")
+        offsets = offsets[order]
+        results = results[order]
+    exact = results
+    if tolerance:
+        results = dilate_counts(offsets, results)
+    measured = np.abs(offsets) <= max(max_offset, radius)
+    searched = np.abs(offsets) <= max_offset
 
     clf = StandardScaler(copy=True)
-    results = clf.fit_transform(results.reshape((-1, 1))).reshape((-1))
+    clf.fit(results[measured].reshape((-1, 1)).astype(np.float64))
+    results = np.where(searched, clf.transform(results.reshape((-1, 1)).astype(np.float64)).reshape((-1)), -np.inf)
     results_significant = np.nonzero(results > 5)[0]
-    
     if results_significant.shape[0] == 0:
-        message = f"\033[31mCould not find a significant relevance between left and right clips between \033[1;33m{print_frame(range_[0])}\033[0;31m and \033[1;33m{print_frame(range_[1])}\033[0;31m.\033[0m\n"
-        if (results_significant := np.nonzero(results > 4)[0]).shape[0] != 0:
+        results_candidate = np.nonzero(results > 4)[0]
+    else:
+        results_candidate = np.zeros((0,), dtype=int)
+    return Section(range_[0], range_[1],
+                   describe_offsets(results_significant, offsets, results, exact),
+                   describe_offsets(results_candidate, offsets, results, exact))
+
+def analyse_offset(left: Keyframes, right: Keyframes) -> list[Section]:
+    length = min(left.length, right.length)
+    section_count = max(math.floor(length / 5754), 1)
+    section_length = math.floor(length / section_count)
+    sections = []
+    for i in range(section_count):
+        range_ = (i * section_length, (i+1) * section_length) if i < section_count - 1 else (i * section_length, length)
+        with profile_stage("guess offset range", start=range_[0], end=range_[1]):
+            sections.append(analyse_offset_range(left, right, range_))
+    return sections
+
+# Returns the sorted frames in region matched at any shift within
+# tolerance frames of offset, from the keys in analyse_offset_timeline.
+def find_window_matches(keys: np.ndarray[int], shifts: np.ndarray[int], length: int, offset: int, region: tuple[int]) -> np.ndarray[int]:
+    bases = np.arange(np.searchsorted(shifts, offset - tolerance, side="left"), np.searchsorted(shifts, offset + tolerance, side="right")) * (length + 1)
+    return np.sort(np.concatenate([keys[np.searchsorted(keys, base + region[0]):np.searchsorted(keys, base + region[1])] - base for base in bases]))
+
+# Slides a 5754 frame window across the clip in steps of 1/8 of the window
+# and picks the significant offset in each window. The matches for every
+# offset are sorted once, so the number of matches in any window is the
+# difference between two cumulative counts found with a binary search.
+# Where the offset changes, the boundary is placed at the frame that best
+# splits the matches of the two offsets. An offset has to be found in
+# windows in a row that stand for at least a whole window of frames, so
+# that it isn't backed by the same few keyframes in each of them. Frames
+# where no offset is found that way are left out, so the segments returned
+# may have gaps between them and may not start at 0 or end at the end of
+# the clip. Returns an empty list if no offset is found.
+def analyse_offset_timeline(left: Keyframes, right: Keyframes) -> list[Segment]:
+    length = min(left.length, right.length)
+    radius = 240
+    frames, offsets = match_keyframes(left, right, (0, length), radius + tolerance)
+    if max_offset > radius:
+        centers, width = find_wide_offset_candidates(left, right, (0, length))
+        for center in centers:
+            wide_frames, wide_offsets = match_keyframes(left, right, (0, length), width + tolerance, center)
+            wide = (np.abs(wide_offsets) > radius + tolerance) & (np.abs(wide_offsets) <= max_offset + tolerance)
+            frames = np.concatenate((frames, wide_frames[wide]))
+            offsets = np.concatenate((offsets, wide_offsets[wide]))
+    shifts = np.union1d(np.arange(-radius - tolerance, radius + tolerance + 1), offsets)
+    keys = np.sort(np.searchsorted(shifts, offsets) * (length + 1) + frames)
+
+    window = min(5754, length)
+    starts = np.arange(0, length - window + 1, max(window // 8, 1))
+    if starts[-1] != length - window:
+        starts = np.append(starts, length - window)
+    bases = (np.arange(shifts.shape[0]) * (length + 1)).reshape((-1, 1))
+    exact = np.searchsorted(keys, bases + starts + window) - np.searchsorted(keys, bases + starts)
+    results = dilate_counts(shifts, exact) if tolerance else exact
+    measured = np.abs(shifts) <= max(max_offset, radius)
+    searched = (np.abs(shifts) <= max_offset).reshape((-1, 1))
+
+    clf = StandardScaler(copy=True)
+    clf.fit(results[measured].astype(np.float64))
+    results = np.where(searched, clf.transform(results.astype(np.float64)), -np.inf)
+    best = results.argmax(axis=0)
+    significant = np.nonzero(results.max(axis=0) > 5)[0]
+    if significant.shape[0] == 0:
+        return []
+
+    # With a tolerance, the best shift of each window sits anywhere on the
+    # plateau of the dilated counts. Move it twice to the shift nearest to
+    # the centroid of the matches within tolerance frames, as in
+    # describe_offsets.
+    if tolerance:
+        columns = np.arange(starts.shape[0]).reshape((-1, 1))
+        for _ in range(2):
+            near = shifts[best].reshape((-1, 1)) + np.arange(-tolerance, tolerance + 1)
+            rows = np.minimum(np.searchsorted(shifts, near), shifts.shape[0] - 1)
+            counts = np.where(shifts[rows] == near, exact[rows, columns], 0)
+            totals = counts.sum(axis=1)
+            centres = np.round((counts * near).sum(axis=1) / np.maximum(totals, 1))
+            moved = np.minimum(np.searchsorted(shifts, centres), shifts.shape[0] - 1)
+            best = np.where((totals > 0) & (shifts[moved] == centres) & (np.abs(shifts[moved]) <= max_offset), moved, best)
+
+    # Each window stands for the frames nearer to its centre than to the
+    # centres of the windows next to it, from edges[i] to edges[i + 1].
+    centres = starts + window // 2
+    edges = np.concatenate(([0], (centres[:-1] + centres[1:]) // 2, [length]))
+
+    # Merge consecutive windows with the same offset into segments of
+    # [offset, first window, last window]. A window without a significant
+    # offset ends the segment, and a segment whose windows stand for less
+    # than a window of frames is dropped as noise. With a tolerance, offsets within tolerance frames
+    # are the same, and each segment takes the offset found in most of its
+    # windows.
+    segments = []
+    for index in significant:
+        if segments and segments[-1][2] == index - 1 and abs(segments[-1][0] - shifts[best[index]]) <= tolerance:
+            segments[-1][2] = index
+        else:
+            segments.append([shifts[best[index]], index, index])
+    segments = [segment for segment in segments if edges[segment[2] + 1] - edges[segment[1]] >= window]
+    if not segments:
+        return []
+    if tolerance:
+        for segment in segments:
+            values, counts = np.unique(shifts[best[significant[(significant >= segment[1]) & (significant <= segment[2])]]], return_counts=True)
+            segment[0] = values[counts.argmax()]
+
+    # Segments in windows next to each other are split where their matches
+    # best split. The frames of the windows between segments that aren't
+    # are left out.
+    timeline = []
+    start = int(edges[segments[0][1]])
+    for previous, next in zip(segments[:-1], segments[1:]):
+        if next[1] == previous[2] + 1:
+            region = (starts[previous[2]], starts[next[1]] + window)
+            previous_frames = find_window_matches(keys, shifts, length, previous[0], region)
+            next_frames = find_window_matches(keys, shifts, length, next[0], region)
+            candidates = np.unique(np.concatenate((previous_frames + 1, next_frames, region)))
+            score = np.searchsorted(previous_frames, candidates) - np.searchsorted(next_frames, candidates)
+            boundary = int(candidates[candidates.shape[0] - 1 - score[::-1].argmax()])
+            timeline.append(Segment(start, boundary, int(previous[0])))
+            start = boundary
+        else:
+            timeline.append(Segment(start, int(edges[previous[2] + 1]), int(previous[0])))
+            start = int(edges[next[1]])
+    timeline.append(Segment(start, int(edges[segments[-1][2] + 1]), int(segments[-1][0])))
+    return timeline
+
+# Returns counts[i, radius + s], the number of frames in the first
+# lengths[i] frames where both left[j] and rights[i][j + s] are keyframes.
+# The keyframes of all targets are merged into one sorted array, so every
+# target is correlated against the reference in the same sorted search.
+def correlate_keyframes_many(left: Keyframes, rights: list[Keyframes], lengths: np.ndarray[int], radius: int) -> np.ndarray[int]:
+    right_frames = np.concatenate([right.frames for right in rights])
+    right_ids = np.concatenate([np.full(right.frames.shape, i) for i, right in enumerate(rights)])
+    order = np.argsort(right_frames, kind="stable")
+    right_frames = right_frames[order]
+    right_ids = right_ids[order]
+
+    left_frames = left.frames[:np.searchsorted(left.frames, lengths.max())]
+    lo = np.searchsorted(right_frames, left_frames - radius, side="left")
+    hi = np.searchsorted(right_frames, left_frames + radius, side="right")
+    counts = hi - lo
+    pairs = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    frames = np.repeat(left_frames, counts)
+    ids = right_ids[pairs]
+    valid = frames < lengths[ids]
+    indices = ids[valid] * (2 * radius + 1) + (right_frames[pairs] - frames)[valid] + radius
+    return np.bincount(indices, minlength=len(rights) * (2 * radius + 1)).reshape((len(rights), 2 * radius + 1))
+
+# The binned correlation in find_wide_offset_candidates, with the spectra
+# of all targets taken in one batched FFT.
+def find_wide_offset_candidates_many(left: Keyframes, rights: list[Keyframes], lengths: np.ndarray[int]) -> tuple[list[list[int]], int]:
+    width = max(max_offset // 256, 4)
+    length = int(lengths.max())
+    left_frames = left.frames[:np.searchsorted(left.frames, length)]
+    left_bins = np.bincount(left_frames // width, minlength=-(-length // width))
+    right_bins = np.zeros((len(rights), -(-(length + 2 * max_offset) // width)))
+    for i, right in enumerate(rights):
+        right_frames = right.frames[:np.searchsorted(right.frames, lengths[i] + max_offset)] + max_offset
+        right_bins[i] = np.bincount(right_frames // width, minlength=right_bins.shape[1])[:right_bins.shape[1]]
+
+    n = 1 << (right_bins.shape[1] - 1).bit_length()
+    spectrum = np.conj(np.fft.rfft(left_bins.astype(np.float64), n)) * np.fft.rfft(right_bins, n, axis=1)
+    coarse = np.fft.irfft(spectrum, n, axis=1)[:, :right_bins.shape[1] - left_bins.shape[0] + 1]
+    return [[int(lag) * width - max_offset for lag in lags] for lags in np.argsort(coarse, axis=1, kind="stable")[:, -8:]], width
+
+# Compares one reference against many targets over their whole lengths.
+def analyse_offset_many(left: Keyframes, rights: list[Keyframes]) -> list[Alignment]:
+    pairs = [complete_keyframes_length(left, right) for right in rights]
+    lengths = np.array([min(left_.length, right.length) for left_, right in pairs])
+    rights = [right for _, right in pairs]
+    left = left._replace(length=int(lengths.max()))
+
+    radius = 240
+    counts = correlate_keyframes_many(left, rights, lengths, radius + tolerance)
+    if max_offset > radius:
+        centers, width = find_wide_offset_candidates_many(left, rights, lengths)
+
+    alignments = []
+    for i, right in enumerate(rights):
+        offsets = np.arange(-radius - tolerance, radius + tolerance + 1)
+        results = counts[i]
+        if max_offset > radius:
+            wide = {}
+            for center in centers[i]:
+                for offset, result in enumerate(correlate_keyframes(left, right, (0, int(lengths[i])), width + tolerance, center), start=center - width - tolerance):
+                    if radius + tolerance < abs(offset) <= max_offset + tolerance:
+                        wide[offset] = result
+            offsets = np.concatenate((offsets, np.array(sorted(wide), dtype=int)))
+            results = np.concatenate((results, np.array([wide[offset] for offset in sorted(wide)], dtype=int)))
+            order = np.argsort(offsets, kind="stable")
+            offsets = offsets[order]
+            results = results[order]
+        exact = results
+        if tolerance:
+            results = dilate_counts(offsets, results)
+        measured = np.abs(offsets) <= max(max_offset, radius)
+        searched = np.abs(offsets) <= max_offset
+
+        clf = StandardScaler(copy=True)
+        clf.fit(results[measured].reshape((-1, 1)).astype(np.float64))
+        unit_variances = np.where(searched, clf.transform(results.reshape((-1, 1)).astype(np.float64)).reshape((-1)), -np.inf)
+        significant = np.nonzero(unit_variances > 5)[0]
+        significant = significant[np.argsort(unit_variances[significant], kind="stable")[::-1]]
+        offsets_found = describe_offsets(significant, offsets, unit_variances, exact)
+        # A reference keyframe may match more than one target keyframe
+        # within tolerance frames, so the share counts distinct frames.
+        left_count = max(int(np.searchsorted(left.frames, lengths[i])), 1)
+        matched = np.unique(match_keyframes(left, right, (0, int(lengths[i])), tolerance, offsets_found[0].offset)[0]).shape[0] if offsets_found else 0
+        alignments.append(Alignment(int(lengths[i]), offsets_found, float(matched / left_count)))
+    return alignments
+
+# With a tolerance, describes where the matches of an offset landed.
+def format_offset_detail(offset: Offset) -> str:
+    if offset.centroid is None:
+        return ""
+    return f" ({offset.exact:.0%} exact, centred at {offset.centroid:+.2f}f)"
+
+def format_section(section: Section) -> typing.Optional[str]:
+    global this_is_likely_due_to
+
+    if len(section.offsets) == 0:
+        message = f"\033[31mCould not find a significant relevance between left and right clips between \033[1;33m{print_frame(section.start)}\033[0;31m and \033[1;33m{print_frame(section.end)}\033[0;31m.\033[0m\n"
+        if len(section.candidates) != 0:
             message += "Timing offset with high unit variance are:\n"
-            for index in results_significant:
-                message += f"\033[31m＊ \033[1;33m{print_offset(index).rjust(4)} \033[0mwith unit variance {results[index]:.3f}\033[31m.\033[0m\n"
+            for offset in section.candidates:
+                message += f"\033[31m＊ \033[1;33m{print_offset(offset.offset).rjust(4)} \033[0mwith unit variance {offset.unit_variance:.3f}{format_offset_detail(offset)}\033[31m.\033[0m\n"
         return message
-    elif results_significant.shape[0] == 1:
-        if results_significant[0] == 240:
+    elif len(section.offsets) == 1:
+        if section.offsets[0].offset == 0:
             return None
         else:
-            return f"\033[34mPossible \033[1;34m{print_offset(results_significant[0])}\033[0;34m offset between \033[1;34m{print_frame(range_[0])}\033[0;34m and \033[1;34m{print_frame(range_[1])}\033[0;34m \033[0mwith unit variance {results[results_significant[0]]:.3f}\033[34m.\033[0m\n"
+            return f"\033[34mPossible \033[1;34m{print_offset(section.offsets[0].offset)}\033[0;34m offset between \033[1;34m{print_frame(section.start)}\033[0;34m and \033[1;34m{print_frame(section.end)}\033[0;34m \033[0mwith unit variance {section.offsets[0].unit_variance:.3f}{format_offset_detail(section.offsets[0])}\033[34m.\033[0m\n"
     else:
-        message = f"\033[34mMultiple possible offsets detected between \033[1;34m{print_frame(range_[0])}\033[0;34m and \033[1;34m{print_frame(range_[1])}\033[0;34m:\033[0m\n"
-        for index in results_significant:
-            message += f"\033[34m＊ \033[1;34m{print_offset(index).rjust(4)} \033[0mwith unit variance {results[index]:.3f}\033[34m.\033[0m\n"
+        message = f"\033[34mMultiple possible offsets detected between \033[1;34m{print_frame(section.start)}\033[0;34m and \033[1;34m{print_frame(section.end)}\033[0;34m:\033[0m\n"
+        for offset in section.offsets:
+            message += f"\033[34m＊ \033[1;34m{print_offset(offset.offset).rjust(4)} \033[0mwith unit variance {offset.unit_variance:.3f}{format_offset_detail(offset)}\033[34m.\033[0m\n"
         if this_is_likely_due_to:
             message += "This is likely due to changes in timing in the middle of the segment, for example, with earlier parts of the segment following one offset and later parts following another, or it might just be a coincident, especially in the case where one offset has very high unit variance while all other offsets have low unit variances.\n"
             this_is_likely_due_to = False
@@ -215,65 +1339,173 @@ def guess_offset_range(left: np.ndarray[bool], right: np.ndarray[bool], range_:
             message += "This may be due to changes in timing in the middle of the segment, or otherwise a coincident.\n"
         return message
 
-def guess_offset(left: np.ndarray[bool], right: np.ndarray[bool]) -> typing.Optional[str]:
+def compare_length(left: Keyframes, right: Keyframes) -> tuple[int, typing.Optional[str]]:
     a_message = None
-    if (length := left.shape[0]) != right.shape[0]:
-        length = min(left.shape[0], right.shape[0])
-        if abs(left.shape[0] - right.shape[0]) > 72:
+    if (length := left.length) != right.length:
+        length = min(left.length, right.length)
+        if abs(left.length - right.length) > 72:
             a_message = "\033[33mLeft and right clips' length differs by more than 72 frames.\033[0m\n"
-            a_message += f"Left clip has {str(left.shape[0])} frames.\n"
-            a_message += f"Right clip has {str(right.shape[0])} frames.\n"
+            a_message += f"Left clip has {str(left.length)} frames.\n"
+            a_message += f"Right clip has {str(right.length)} frames.\n"
+    return length, a_message
+
+def join_messages(a_message: typing.Optional[str], b_message: typing.Optional[str]) -> typing.Optional[str]:
+    if a_message and (not b_message):
+        return a_message + "No timing differences were detected. Left and right clips are aligned.\n"
+    elif (not a_message) and (not b_message):
+        return None
+    elif (not a_message) and b_message:
+        return b_message
+    else:
+        return a_message + b_message
+
+# Caller must assure that range was valid for both left and right array.
+def guess_offset_range(left: Keyframes, right: Keyframes, range_: tuple[int]) -> typing.Optional[str]:
+    return format_section(analyse_offset_range(left, right, range_))
+
+def guess_offset(left: Keyframes, right: Keyframes) -> typing.Optional[str]:
+    length, a_message = compare_length(left, right)
     
     b_message = None
     if length < 481:
         b_message = "\033[31mComparations on clips whose lengths are under 481 frames are not supported.\033[0m\n"
-        b_message += str(left.shape)
+        b_message += str((left.length,))
     else:
-        section_count = math.floor(length / 5754)
-        section_length = math.floor(length / section_count)
-        for i in range(section_count):
-            if i < section_count - 1:
-                return_message = guess_offset_range(left, right, (i * section_length, (i+1) * section_length))
-            else:
-                return_message = guess_offset_range(left, right, (i * section_length, length))
-            if return_message:
+        for section in analyse_offset(left, right):
+            if return_message := format_section(section):
                 if b_message is None:
                     b_message = return_message
                 else:
                     b_message += return_message
 
-    if a_message and (not b_message):
-        return a_message + "No timing differences were detected. Left and right clips are aligned.\n"
-    elif (not a_message) and (not b_message):
-        return None
-    elif (not a_message) and b_message:
-        return b_message
-    else:
-        return a_message + b_message
+    return join_messages(a_message, b_message)
+
+def guess_offset_timeline(left: Keyframes, right: Keyframes) -> typing.Optional[str]:
+    length, a_message = compare_length(left, right)
+    if length < 481:
+        b_message = "\033[31mComparations on clips whose lengths are under 481 frames are not supported.\033[0m\n"
+        b_message += str((left.length,))
+        return join_messages(a_message, b_message)
 
-parser = argparse.ArgumentParser(prog="TimingOffset", description="Detect whether Web and BD sources align based on video keyframe")
-parser.add_argument("left", type=Path, help="The clip to compare against. Supports video file, lwi file, keyframe format file, or directory containing such files (smart)")
-parser.add_argument("right", type=Path, help="The clip to compare. Supports video file, lwi file, keyframe format file, or directory containing such files (smart)")
-args = parser.parse_args()
-left = args.left
-right = args.right
+    timeline = analyse_offset_timeline(left, right)
+    if len(timeline) == 0:
+        b_message = f"\033[31mCould not find a significant relevance between left and right clips between \033[1;33m{print_frame(0)}\033[0;31m and \033[1;33m{print_frame(length)}\033[0;31m.\033[0m\n"
+        return join_messages(a_message, b_message)
+    elif len(timeline) == 1 and timeline[0].offset == 0 and timeline[0].start == 0 and timeline[0].end == length:
+        return join_messages(a_message, None)
+
+    b_message = f"\033[34mTimeline of offsets:\033[0m\n"
+    end = 0
+    for segment in timeline:
+        if segment.start > end:
+            b_message += f"\033[31m＊ No significant offset between \033[1;33m{print_frame(end)}\033[0;31m and \033[1;33m{print_frame(segment.start)}\033[0;31m.\033[0m\n"
+        b_message += f"\033[34m＊ \033[1;34m{print_offset(segment.offset).rjust(4)}\033[0;34m between \033[1;34m{print_frame(segment.start)}\033[0;34m and \033[1;34m{print_frame(segment.end)}\033[0;34m.\033[0m\n"
+        end = segment.end
+    if end < length:
+        b_message += f"\033[31m＊ No significant offset between \033[1;33m{print_frame(end)}\033[0;31m and \033[1;33m{print_frame(length)}\033[0;31m.\033[0m\n"
+    return join_messages(a_message, b_message)
+
+# Ranks the targets by the share of the reference's keyframes that they
+# match. Targets without a significant offset are ranked last.
+def guess_offset_many(left: Keyframes, rights: list[Keyframes], names: list[str]) -> str:
+    message = ""
+    for rank, (alignment, name) in enumerate(sorted(zip(analyse_offset_many(left, rights), names), key=lambda item: item[0].matched, reverse=True), start=1):
+        if len(alignment.offsets) == 0:
+            message += f"\033[31m{rank}. \033[0m\"{name}\"\033[31m: Could not find a significant relevance with left reference.\033[0m\n"
+            continue
+        message += f"\033[34m{rank}. \033[0m\"{name}\"\033[34m: \033[1;34m{print_offset(alignment.offsets[0].offset)}\033[0;34m offset matching \033[1;34m{alignment.matched:.1%}\033[0;34m of keyframes \033[0mwith unit variance {alignment.offsets[0].unit_variance:.3f}{format_offset_detail(alignment.offsets[0])}\033[34m.\033[0m\n"
+        for offset in alignment.offsets[1:]:
+            message += f"\033[34m   Also \033[1;34m{print_offset(offset.offset).rjust(4)} \033[0mwith unit variance {offset.unit_variance:.3f}{format_offset_detail(offset)}\033[34m.\033[0m\n"
+    return message
+
+# Returns the keyframes together with the fps found in the clip, or None
+# if the clip doesn't record its fps. The extractors report the fps in
+# fps_num and fps_den, which are restored afterwards even if extraction
+# fails, so that a broken file doesn't leave a zero fps behind for the
+# files compared after it.
+def get_keyframes_fps(clip: Path) -> tuple[Keyframes, typing.Optional[tuple[int]]]:
+    global fps_num
+    global fps_den
+
+    fps = (fps_num, fps_den)
+    fps_num = 0
+    try:
+        keyframes = get_keyframes(clip)
+        found = (fps_num, fps_den) if fps_num != 0 else None
+    finally:
+        fps_num, fps_den = fps
+    return keyframes, found
+
+# Runs in worker processes for --jobs. The cache and profile settings and
+# the scanned file are passed in explicitly since they are not set in
+# freshly spawned processes. The profile events recorded in the worker are
+# returned along with the keyframes and collected with
+# collect_worker_result, together with the bytes read and the peak memory
+# of the whole extraction, which are added to the stage waiting for it.
+def get_keyframes_worker(clip: Path, settings: tuple, scanned: typing.Optional[ScannedFile] = None) -> tuple[Keyframes, typing.Optional[tuple[int]], list[dict], list[int], list[str]]:
+    global cache_dir
+    global cache_hash
+    global cache_size
+    global force_lsmas
+    global scene_change
+    global worker_warnings
+
+    cache_dir, cache_hash, cache_size, force_lsmas, scene_change, profile = settings
+    if profile:
+        start_profile()
+    worker_warnings = []
+    scanned_files.clear()
+    if scanned is not None:
+        scanned_files[clip] = scanned
+    if not profile:
+        keyframes, fps = get_keyframes_fps(clip)
+        return keyframes, fps, [], [0, 0], worker_warnings
+
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    usage = {"bytes": 0, "peak": base}
+    profile_stack.append(usage)
+    try:
+        keyframes, fps = get_keyframes_fps(clip)
+    finally:
+        profile_stack.pop()
+    usage["peak"] = max(usage["peak"], tracemalloc.get_traced_memory()[1])
+    return keyframes, fps, profile_events, [usage["bytes"], usage["peak"] - base], worker_warnings
+
+def collect_worker_result(result: tuple[Keyframes, typing.Optional[tuple[int]], list[dict], list[int], list[str]]) -> tuple[Keyframes, typing.Optional[tuple[int]]]:
+    keyframes, fps, events, usage, warnings = result
+    if profile_events is not None:
+        profile_events.extend(events)
+        events.clear()
+        if profile_stack:
+            profile_stack[-1]["bytes"] += usage[0]
+            profile_stack[-1]["peak"] = max(profile_stack[-1]["peak"], tracemalloc.get_traced_memory()[0] + usage[1])
+        usage[:] = [0, 0]
+    for message in warnings:
+        print(message, file=sys.stderr)
+    warnings.clear()
+    return keyframes, fps
+
+def silence_worker() -> None:
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+    os.close(devnull)
 
 file_match = re.compile(r"(?<![a-z0-9A-DF-OQ-Z])([0-9]{2,3}(?:\.[0-9])?)[^a-uw-z0-9A-Z\.]")
-messaged = False
 
 def convert_path_to_list_of_files(path: Path):
     if path.is_file():
         return [path]
 
     elif path.is_dir():
+        scanned = scan_directory(path, file_match.search)
         file_dict = {}
-        for file in path.iterdir():
-            if file.is_file() and (match := file_match.search(file.name)):
-                file_key = float(match.group(1))
-                if file_key in file_dict:
-                    file_dict[file_key].append(file)
-                else:
-                    file_dict[file_key] = [file]
+        for file in scanned:
+            file_key = float(file_match.search(file.name).group(1))
+            if file_key in file_dict:
+                file_dict[file_key].append(file)
+            else:
+                file_dict[file_key] = [file]
 
         file_list = []
         for key in sorted(file_dict):
@@ -284,15 +1516,15 @@ def convert_path_to_list_of_files(path: Path):
                 keyframe_format = None
                 lwi = None
                 for file in file_dict[key]:
-                    if guess_filetype(file) == "binary":
+                    if scanned[file].filetype == "binary":
                         if binary is None:
                             binary = file
                         else:
-                            if file.stat().st_size > binary.stat().st_size:
+                            if scanned[file].size > scanned[binary].size:
                                 binary = file
-                    elif guess_filetype(file) == "lwi":
+                    elif scanned[file].filetype == "lwi":
                         lwi = file
-                    elif guess_filetype(file) == "keyframe_format":
+                    elif scanned[file].filetype == "keyframe_format":
                         keyframe_format = file
                     else:
                         raise ValueError
@@ -309,31 +1541,511 @@ def convert_path_to_list_of_files(path: Path):
     else:
         raise ValueError(f"Path \"{path.as_posix()}\" is neither a file nor a directory.")
 
-left = convert_path_to_list_of_files(left)
-right = convert_path_to_list_of_files(right)
-
-if len(left) != len(right):
-    raise ValueError(f"Number of files in the left is different than number of files in the right.\n\tFiles in the left: {str([file.name for file in left])}\n\tFiles in the right: {str([file.name for file in right])}")
-if len(left) == 0:
-    raise ValueError(f"No file is recognised in either provided directories.")
-
-for i in range(len(left)):
-    if (match := file_match.search(right[i].name)) or (match := file_match.search(left[i].name)):
-        print(f"\033[1;37mComparing Episode {float(match.group(1)):02g}...\033[0m", end="\n")
-    left_ = get_keyframes(left[i])
-    right_ = get_keyframes(right[i])
-    left_, right_ = inflate_keyframes_array(left_, right_)
-    message = guess_offset(left_, right_)
-    if message:
-        messaged = True
-        if match:
-            print(f"\r\033[1A\033[K\033[1;37mOffsets in Episode {float(match.group(1)):02g} between left reference \033[0m\"{left[i].name}\"\033[1;37m and right target \033[0m\"{right[i].name}\"\033[1;37m:\033[0m", end="\n")
-            print(message, end="")
+# Returns the pairs of left and right files to compare, with the episode
+# number recognised from their filenames.
+def pair_files(left: Path, right: Path) -> list[tuple[Path, Path, typing.Optional[float]]]:
+    left = convert_path_to_list_of_files(left)
+    right = convert_path_to_list_of_files(right)
+
+    if len(left) != len(right):
+        raise ValueError(f"Number of files in the left is different than number of files in the right.\n\tFiles in the left: {str([file.name for file in left])}\n\tFiles in the right: {str([file.name for file in right])}")
+    if len(left) == 0:
+        raise ValueError(f"No file is recognised in either provided directories.")
+
+    pairs = []
+    for i in range(len(left)):
+        if (match := file_match.search(right[i].name)) or (match := file_match.search(left[i].name)):
+            pairs.append((left[i], right[i], float(match.group(1))))
         else:
-            print(message, end="")
+            pairs.append((left[i], right[i], None))
+    return pairs
+
+video_suffixes = {".mkv", ".mka", ".mks", ".webm", ".mp4", ".m4v", ".mov", ".m2ts", ".mts", ".ts", ".avi", ".flv", ".wmv", ".264", ".265", ".h264", ".h265", ".hevc", ".avc", ".vob"}
+
+# Lists every video, lwi and keyframe format file regardless of its name.
+# If an lwi or keyframe format file is named after a video file, it is
+# used in place of the video.
+def list_keyframe_files(path: Path) -> list[Path]:
+    if path.is_file():
+        return [path]
+    elif not path.is_dir():
+        raise ValueError(f"Path \"{path.as_posix()}\" is neither a file nor a directory.")
+
+    files = {}
+    for file, scanned in scan_directory(path).items():
+        if scanned.filetype != "binary" or file.suffix.lower() in video_suffixes:
+            files[file] = scanned.filetype
+    for file, filetype in list(files.items()):
+        if filetype == "binary" and any(other.stem in (file.stem, file.name) and other_filetype != "binary" for other, other_filetype in files.items()):
+            del files[file]
+    return list(files)
+
+# Hashes the two intervals between every keyframe and the next 1 to 3
+# keyframes after it, and 1 to 3 keyframes after that. The intervals
+# don't change with timing offsets, and the fan-out keeps hashes matching
+# where one of the clips has extra keyframes. Hashes that repeat within a
+# clip, such as those from fixed GOPs, are dropped.
+def fingerprint_keyframes(keyframes: Keyframes) -> tuple[np.ndarray[np.int64], np.ndarray[np.int64]]:
+    frames = keyframes.frames.astype(np.int64)
+    hashes = []
+    positions = []
+    for a in range(1, 4):
+        for b in range(1, 4):
+            if frames.shape[0] <= a + b:
+                continue
+            i = np.arange(frames.shape[0] - a - b)
+            hashes.append(np.minimum(frames[i + a] - frames[i], 65535) << 16 | np.minimum(frames[i + a + b] - frames[i + a], 65535))
+            positions.append(frames[i])
+    if not hashes:
+        return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.int64)
+    hashes = np.concatenate(hashes)
+    positions = np.concatenate(positions)
+
+    _, inverse, counts = np.unique(hashes, return_inverse=True, return_counts=True)
+    keep = counts[inverse] <= 4
+    return hashes[keep], positions[keep]
+
+# Pairs files by their keyframes instead of by their filenames. The
+# fingerprints of all right files are put in one inverted index sorted by
+# hash. Each left file looks up its hashes in the index and votes for the
+# right file and the offset between the matching positions. A right file
+# scores the most votes it receives at any one offset, so that matches
+# need to agree on an offset. Pairs are then taken greedily from the
+# highest score. Returns the pairs and the files that were not paired.
+def pair_files_by_keyframes(left: list[Path], right: list[Path], get: typing.Callable[[Path], Keyframes]) -> tuple[list[tuple[Path, Path, typing.Optional[float]]], list[Path], list[Path]]:
+    index_hashes = []
+    index_positions = []
+    index_files = []
+    for i, file in enumerate(right):
+        hashes, positions = fingerprint_keyframes(get(file))
+        index_hashes.append(hashes)
+        index_positions.append(positions)
+        index_files.append(np.full(hashes.shape, i, dtype=np.int64))
+    index_hashes = np.concatenate(index_hashes) if right else np.zeros((0,), dtype=np.int64)
+    order = np.argsort(index_hashes, kind="stable")
+    index_hashes = index_hashes[order]
+    index_positions = np.concatenate(index_positions)[order] if right else np.zeros((0,), dtype=np.int64)
+    index_files = np.concatenate(index_files)[order] if right else np.zeros((0,), dtype=np.int64)
+
+    scores = np.zeros((len(left), len(right)), dtype=np.int64)
+    for i, file in enumerate(left):
+        hashes, positions = fingerprint_keyframes(get(file))
+        lo = np.searchsorted(index_hashes, hashes, side="left")
+        hi = np.searchsorted(index_hashes, hashes, side="right")
+        counts = hi - lo
+        matches = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        offsets = (index_positions[matches] - np.repeat(positions, counts)) // 48
+        votes = index_files[matches] << 32 | (offsets + (1 << 31))
+        votes, counts = np.unique(votes, return_counts=True)
+        np.maximum.at(scores[i], votes >> 32, counts)
+
+    pairs = []
+    left_paired = set()
+    right_paired = set()
+    for index in np.argsort(scores, axis=None, kind="stable")[::-1]:
+        i, j = np.unravel_index(index, scores.shape)
+        if scores[i, j] < 16:
+            break
+        if i in left_paired or j in right_paired:
+            continue
+        left_paired.add(i)
+        right_paired.add(j)
+        if (match := file_match.search(right[j].name)) or (match := file_match.search(left[i].name)):
+            pairs.append((left[i], right[j], float(match.group(1))))
+        else:
+            pairs.append((left[i], right[j], None))
+    pairs.sort(key=lambda pair: (pair[2] is None, pair[2] if pair[2] is not None else 0, pair[0].name))
+    return pairs, [file for i, file in enumerate(left) if i not in left_paired], [file for j, file in enumerate(right) if j not in right_paired]
+
+# The library API. sections is empty in timeline mode, and timeline is
+# None outside timeline mode.
+class Comparison(typing.NamedTuple):
+    left: Path
+    right: Path
+    episode: typing.Optional[float]
+    left_length: int
+    right_length: int
+    fps: tuple[int]
+    sections: list[Section]
+    timeline: typing.Optional[list[Segment]]
+
+# Keyframes kept in memory between comparisons, keyed by path, size and
+# mtime, so that a long-running process doesn't read the same file twice.
+keyframes_memory = {}
+keyframes_memory_size = 1024
+
+def get_keyframes_memory(clip: Path) -> tuple[Keyframes, typing.Optional[tuple[int]]]:
+    key = (resolve_file(clip), *get_file_stat(clip))
+    if key in keyframes_memory:
+        keyframes_memory[key] = keyframes_memory.pop(key)
+        return keyframes_memory[key]
+
+    keyframes_memory[key] = get_keyframes_fps(clip)
+    while len(keyframes_memory) > keyframes_memory_size:
+        del keyframes_memory[next(iter(keyframes_memory))]
+    return keyframes_memory[key]
+
+# The analysis reads max_offset and tolerance from the module level
+# settings. The library API sets them for one call while holding
+# analysis_lock, so that calls from different threads don't see each
+# other's settings. A setting that is None is left as it is.
+analysis_lock = threading.RLock()
+
+@contextlib.contextmanager
+def offset_settings(max_offset_: typing.Optional[int], tolerance_: typing.Optional[int]) -> typing.Iterator[None]:
+    global max_offset, tolerance
+
+    if max_offset_ is not None and max_offset_ < 0:
+        raise ValueError("max_offset must not be negative")
+    if tolerance_ is not None and tolerance_ < 0:
+        raise ValueError("tolerance must not be negative")
+    with analysis_lock:
+        saved = (max_offset, tolerance)
+        if max_offset_ is not None:
+            max_offset = max_offset_
+        if tolerance_ is not None:
+            tolerance = tolerance_
+        try:
+            yield
+        finally:
+            max_offset, tolerance = saved
+
+# Compares two files and returns the report as guess_offset and
+# guess_offset_timeline do. get returns the keyframes and fps of a file.
+def guess_offset_files(left: Path, right: Path, timeline: bool = False,
+                       get: typing.Callable[[Path], tuple[Keyframes, typing.Optional[tuple[int]]]] = get_keyframes_memory) -> typing.Optional[str]:
+    global fps_num
+    global fps_den
+
+    left_keyframes, left_fps = get(left)
+    right_keyframes, right_fps = get(right)
+    if right_fps is not None:
+        fps_num, fps_den = right_fps
+    elif left_fps is not None:
+        fps_num, fps_den = left_fps
+    left_keyframes, right_keyframes = complete_keyframes_length(left_keyframes, right_keyframes)
+    with profile_stage("analyse"):
+        if timeline:
+            return guess_offset_timeline(left_keyframes, right_keyframes)
+        else:
+            return guess_offset(left_keyframes, right_keyframes)
+
+def compare_keyframe_files(left: Path, right: Path, timeline: bool, episode: typing.Optional[float]) -> Comparison:
+    left_keyframes, left_fps = get_keyframes_memory(left)
+    right_keyframes, right_fps = get_keyframes_memory(right)
+    left_keyframes, right_keyframes = complete_keyframes_length(left_keyframes, right_keyframes)
+    if min(left_keyframes.length, right_keyframes.length) < 481:
+        raise ValueError("Comparations on clips whose lengths are under 481 frames are not supported.")
+
+    if right_fps is not None:
+        fps = right_fps
+    elif left_fps is not None:
+        fps = left_fps
+    else:
+        fps = (fps_num, fps_den)
+    if timeline:
+        return Comparison(left, right, episode, left_keyframes.length, right_keyframes.length, fps, [], analyse_offset_timeline(left_keyframes, right_keyframes))
     else:
-        if match:
-            print("\r\033[1A\033[K", end="")
+        return Comparison(left, right, episode, left_keyframes.length, right_keyframes.length, fps, analyse_offset(left_keyframes, right_keyframes), None)
+
+# Each call of the library API scans the files again, so that files
+# changed since the last call aren't taken from keyframes_memory.
+def compare_files(left: Path, right: Path, timeline: bool = False, episode: typing.Optional[float] = None,
+                  max_offset: typing.Optional[int] = None, tolerance: typing.Optional[int] = None) -> Comparison:
+    with offset_settings(max_offset, tolerance):
+        scanned_files.clear()
+        return compare_keyframe_files(left, right, timeline, episode)
+
+def compare_paths(left: Path, right: Path, timeline: bool = False, fingerprint: bool = False,
+                  max_offset: typing.Optional[int] = None, tolerance: typing.Optional[int] = None) -> list[Comparison]:
+    with offset_settings(max_offset, tolerance):
+        scanned_files.clear()
+        if fingerprint:
+            pairs, _, _ = pair_files_by_keyframes(list_keyframe_files(left), list_keyframe_files(right), lambda clip: get_keyframes_memory(clip)[0])
+        else:
+            pairs = pair_files(left, right)
+        return [compare_keyframe_files(left_file, right_file, timeline, episode) for left_file, right_file, episode in pairs]
+
+# A target compared against the reference in rank_targets.
+class Ranking(typing.NamedTuple):
+    left: Path
+    right: Path
+    left_length: int
+    right_length: int
+    fps: tuple[int]
+    alignment: Alignment
+
+# Compares one reference file against many target files and returns them
+# ranked by alignment, best first.
+def rank_targets(left: Path, rights: list[Path], max_offset: typing.Optional[int] = None, tolerance: typing.Optional[int] = None) -> list[Ranking]:
+    with offset_settings(max_offset, tolerance):
+        scanned_files.clear()
+        left_keyframes, left_fps = get_keyframes_memory(left)
+        rights_keyframes = [get_keyframes_memory(right) for right in rights]
+        rankings = []
+        for right, (right_keyframes, right_fps), alignment in zip(rights, rights_keyframes, analyse_offset_many(left_keyframes, [right_keyframes for right_keyframes, _ in rights_keyframes])):
+            if right_fps is not None:
+                fps = right_fps
+            elif left_fps is not None:
+                fps = left_fps
+            else:
+                fps = (fps_num, fps_den)
+            left_keyframes_, right_keyframes = complete_keyframes_length(left_keyframes, right_keyframes)
+            rankings.append(Ranking(left, right, left_keyframes_.length, right_keyframes.length, fps, alignment))
+    return sorted(rankings, key=lambda ranking: ranking.alignment.matched, reverse=True)
+
+def comparison_to_json(comparison: Comparison) -> dict:
+    result = comparison._asdict()
+    result["left"] = comparison.left.as_posix()
+    result["right"] = comparison.right.as_posix()
+    result["fps"] = list(comparison.fps)
+    result["sections"] = [{"start": section.start, "end": section.end,
+                           "offsets": [offset._asdict() for offset in section.offsets],
+                           "candidates": [offset._asdict() for offset in section.candidates]} for section in comparison.sections]
+    if comparison.timeline is not None:
+        result["timeline"] = [segment._asdict() for segment in comparison.timeline]
+    return result
+
+def ranking_to_json(ranking: Ranking) -> dict:
+    return {"left": ranking.left.as_posix(), "right": ranking.right.as_posix(),
+            "left_length": ranking.left_length, "right_length": ranking.right_length, "fps": list(ranking.fps),
+            "offsets": [offset._asdict() for offset in ranking.alignment.offsets], "matched": ranking.alignment.matched}
+
+# Daemon mode. Each line received on the socket is a JSON job such as
+# {"left": "Web", "right": "BD", "timeline": false, "max_offset": 240,
+# "tolerance": 0, "fingerprint": false},
+# and each job is answered with one line of JSON, either
+# {"comparisons": [...]} or {"error": "..."}. A job with "targets", a list
+# of files, in place of "right" is answered with {"rankings": [...]}. Each
+# connection is served on its own thread and may send any number of jobs,
+# but jobs from all connections are analysed one at a time under
+# analysis_lock since the analysis uses module level settings.
+class ComparisonHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+                job_max_offset = int(job["max_offset"]) if job.get("max_offset") is not None else None
+                job_tolerance = int(job["tolerance"]) if job.get("tolerance") is not None else None
+                with analysis_lock:
+                    if "targets" in job:
+                        rankings = rank_targets(Path(job["left"]), [Path(target) for target in job["targets"]], job_max_offset, job_tolerance)
+                        response = {"rankings": [ranking_to_json(ranking) for ranking in rankings]}
+                    else:
+                        comparisons = compare_paths(Path(job["left"]), Path(job["right"]), bool(job.get("timeline", False)), bool(job.get("fingerprint", False)), job_max_offset, job_tolerance)
+                        response = {"comparisons": [comparison_to_json(comparison) for comparison in comparisons]}
+            except Exception as e:
+                response = {"error": f"{type(e).__name__}: {e}"}
+            self.wfile.write(json.dumps(response).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+def serve(socket_path: Path) -> None:
+    if not hasattr(socketserver, "UnixStreamServer"):
+        raise ValueError("Daemon mode requires Unix domain sockets, which are not supported on this platform.")
+    if socket_path.is_socket():
+        socket_path.unlink()
+
+    signal.signal(signal.SIGTERM, lambda sig, frame: sys.exit())
+    with socketserver.ThreadingUnixStreamServer(socket_path.as_posix(), ComparisonHandler) as server:
+        server.daemon_threads = True
+        print(f"\033[1;37mListening on \033[0m\"{socket_path.as_posix()}\"\033[1;37m...\033[0m", file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            socket_path.unlink(missing_ok=True)
+
+# Pairs files with the same episode number in the left and right
+# directories. Unlike pair_files, episodes that are only in one of the
+# directories are returned separately instead of being an error.
+def pair_files_by_episode(left: Path, right: Path) -> tuple[list[tuple[Path, Path, typing.Optional[float]]], list[Path], list[Path]]:
+    if left.is_file() and right.is_file():
+        return pair_files(left, right), [], []
+
+    left = {float(file_match.search(file.name).group(1)) if file_match.search(file.name) else None: file for file in convert_path_to_list_of_files(left)}
+    right = {float(file_match.search(file.name).group(1)) if file_match.search(file.name) else None: file for file in convert_path_to_list_of_files(right)}
+    pairs = [(left[episode], right[episode], episode) for episode in sorted(left.keys() & right.keys() - {None})]
+    return pairs, [file for episode, file in left.items() if episode not in right], [file for episode, file in right.items() if episode not in left]
+
+ansi_escape = re.compile(r"\033\[[0-9;]*[A-Za-z]")
+
+# Watch mode. The left and right directories are scanned every interval
+# seconds, and every pair of files that is new or has changed since it was
+# last compared is compared and reported. A file is only read once its
+# size and modification time have stopped changing between two scans, or
+# once it hasn't been modified for interval seconds, so that files still
+# being copied into the directories are left for later. Keyframes of
+# unchanged files are kept in keyframes_memory, so each new episode costs
+# the same no matter how many episodes came before it.
+def watch(left: Path, right: Path, timeline: bool, fingerprint: bool, interval: float, report: typing.Optional[Path]) -> None:
+    seen = {}
+    compared = set()
+
+    print(f"\033[1;37mWatching \033[0m\"{left.as_posix()}\"\033[1;37m and \033[0m\"{right.as_posix()}\"\033[1;37m for new episodes...\033[0m", end="\n")
+    try:
+        while True:
+            scanned_files.clear()
+            if fingerprint:
+                files = (list_keyframe_files(left), list_keyframe_files(right))
+            else:
+                pairs, _, _ = pair_files_by_episode(left, right)
+                files = ([left_file for left_file, _, _ in pairs], [right_file for _, right_file, _ in pairs])
+
+            stable = set()
+            for file in files[0] + files[1]:
+                stat = get_file_stat(file)
+                if seen.get(file) == stat or time.time_ns() - stat[1] > interval * 1000000000:
+                    stable.add(file)
+                seen[file] = stat
+
+            if fingerprint:
+                pairs, _, _ = pair_files_by_keyframes([file for file in files[0] if file in stable], [file for file in files[1] if file in stable], lambda clip: get_keyframes_memory(clip)[0])
+            else:
+                pairs = [pair for pair in pairs if pair[0] in stable and pair[1] in stable]
+
+            for left_file, right_file, episode in pairs:
+                key = (resolve_file(left_file), seen[left_file], resolve_file(right_file), seen[right_file])
+                if key in compared:
+                    continue
+                compared.add(key)
+
+                if episode is not None:
+                    message = f"\033[1;37mOffsets in Episode {episode:02g} between left reference \033[0m\"{left_file.name}\"\033[1;37m and right target \033[0m\"{right_file.name}\"\033[1;37m:\033[0m\n"
+                else:
+                    message = f"\033[1;37mOffsets between left reference \033[0m\"{left_file.name}\"\033[1;37m and right target \033[0m\"{right_file.name}\"\033[1;37m:\033[0m\n"
+                try:
+                    message += guess_offset_files(left_file, right_file, timeline) or "No timing differences were detected. Left and right clips are aligned.\n"
+                except Exception as e:
+                    message += f"\033[31m{type(e).__name__}: {e}\033[0m\n"
+                print(message, end="", flush=True)
+                if report is not None:
+                    with report.open("a", encoding="utf-8") as f:
+                        f.write(f"[{datetime.now().isoformat(sep=' ', timespec='seconds')}] " + ansi_escape.sub("", message))
+
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="TimingOffset", description="Detect whether Web and BD sources align based on video keyframe")
+    parser.add_argument("left", type=Path, nargs="?", help="The clip to compare against. Supports video file, lwi file, keyframe format file, or directory containing such files (smart)")
+    parser.add_argument("right", type=Path, nargs="*", help="The clip to compare. Supports video file, lwi file, keyframe format file, or directory containing such files (smart). If multiple files are given, rank them by how well they align with left")
+    parser.add_argument("--cache-dir", type=Path, default=get_default_cache_dir(), help="Directory to cache keyframes extracted from video files in (default: \"%(default)s\")")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the keyframe cache")
+    parser.add_argument("--cache-hash", action="store_true", help="Identify cached video files by size and a hash of their content instead of by path, size and modification time")
+    parser.add_argument("--cache-size", type=float, default=256, help="Maximum size of the keyframe cache in MiB (default: %(default)s)")
+    parser.add_argument("--force-lsmas", action="store_true", help="Always index video files with lsmas instead of reading keyframes from Matroska and MP4 headers")
+    parser.add_argument("--scene-change", choices=["auto", "always", "never"], default="auto", help="Detect scene changes from the decoded frames of video files instead of using their keyframes. auto does so only for video files with a fixed GOP (default: %(default)s)")
+    parser.add_argument("-m", "--max-offset", type=int, default=240, help="Largest offset in frames to search for (default: %(default)s)")
+    parser.add_argument("-k", "--tolerance", type=int, default=0, help="Count keyframes up to this many frames apart as matching, for encoders that place keyframes a frame or two off the scene cut or sources with dropped frames. Each offset is then reported with where its matches are centred (default: %(default)s)")
+    parser.add_argument("-t", "--timeline", action="store_true", help="Slide a window across each clip and report the exact frame ranges where each offset applies, instead of reporting offsets for fixed sections")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of files to extract keyframes from in parallel when comparing folders (default: %(default)s)")
+    parser.add_argument("-f", "--fingerprint", action="store_true", help="Pair files in the left and right directories by their keyframes instead of by episode numbers in their filenames")
+    parser.add_argument("--profile", type=Path, metavar="TRACE", help="Record the wall time, bytes read and peak memory of each stage and each episode to this JSON file in the trace event format, and print a summary at the end")
+    parser.add_argument("-w", "--watch", action="store_true", help="Keep watching the left and right directories and compare new or changed episodes as they appear")
+    parser.add_argument("--interval", type=float, default=60, help="Seconds between scans of the directories in --watch mode (default: %(default)s)")
+    parser.add_argument("--report", type=Path, help="In --watch mode, also append every comparison to this file")
+    parser.add_argument("--daemon", type=Path, metavar="SOCKET", help="Instead of comparing left and right, listen on this Unix socket for comparison jobs in JSON and answer them in JSON")
+    args = parser.parse_args()
+    if args.daemon is None and (args.left is None or len(args.right) == 0):
+        parser.error("the following arguments are required: left, right")
+    if len(args.right) > 1 and (args.timeline or args.fingerprint or args.watch):
+        parser.error("--timeline, --fingerprint and --watch can't be used with multiple right targets")
+    if len(args.right) > 1 and not all(path.is_file() for path in [args.left] + args.right):
+        parser.error("left and right must be files when comparing against multiple right targets")
+    if not args.no_cache:
+        cache_dir = args.cache_dir
+        cache_hash = args.cache_hash
+        cache_size = int(args.cache_size * 1048576)
+    force_lsmas = args.force_lsmas
+    scene_change = args.scene_change
+    if args.max_offset < 0:
+        parser.error("--max-offset must not be negative")
+    max_offset = args.max_offset
+    if args.tolerance < 0:
+        parser.error("--tolerance must not be negative")
+    tolerance = args.tolerance
+
+    if args.daemon is not None:
+        serve(args.daemon)
+        sys.exit()
+
+    if platform.system() == "Windows":
+        os.system("")
+
+    if args.watch:
+        watch(args.left, args.right[0], args.timeline, args.fingerprint, args.interval, args.report)
+        sys.exit()
+
+    if args.profile is not None:
+        start_profile()
+
+    with profile_stage("scan"):
+        if len(args.right) > 1:
+            files = ([args.left], args.right)
+        elif args.fingerprint:
+            files = (list_keyframe_files(args.left), list_keyframe_files(args.right[0]))
+        else:
+            pairs = pair_files(args.left, args.right[0])
+            files = ([left for left, _, _ in pairs], [right for _, right, _ in pairs])
+
+    messaged = False
+    executor = None
+    if args.jobs > 1:
+        executor = ProcessPoolExecutor(max_workers=args.jobs, initializer=silence_worker)
+        futures = {}
+        for file in files[0] + files[1]:
+            if resolve_file(file) not in futures:
+                futures[resolve_file(file)] = executor.submit(get_keyframes_worker, file, (cache_dir, cache_hash, cache_size, force_lsmas, scene_change, args.profile is not None), scanned_files.get(file))
+        get_keyframes_fps_ = lambda clip: collect_worker_result(futures[resolve_file(clip)].result())
+    else:
+        get_keyframes_fps_ = get_keyframes_memory
+
+    if len(args.right) > 1:
+        left_, _ = get_keyframes_fps_(args.left)
+        rights = [get_keyframes_fps_(right) for right in args.right]
+        print(f"\033[1;37mRight targets ranked by alignment with left reference \033[0m\"{args.left.name}\"\033[1;37m:\033[0m", end="\n")
+        with profile_stage("one vs many"):
+            print(guess_offset_many(left_, [right for right, _ in rights], [right.name for right in args.right]), end="")
+        if executor is not None:
+            executor.shutdown()
+        if args.profile is not None:
+            print(finish_profile(args.profile), end="")
+        sys.exit()
+
+    if args.fingerprint:
+        with profile_stage("fingerprint"):
+            pairs, left_unpaired, right_unpaired = pair_files_by_keyframes(files[0], files[1], lambda clip: get_keyframes_fps_(clip)[0])
+        for file in left_unpaired:
+            print(f"\033[33mCould not find a match for left reference \033[0m\"{file.name}\"\033[33m in the right.\033[0m", end="\n")
+        for file in right_unpaired:
+            print(f"\033[33mCould not find a match for right target \033[0m\"{file.name}\"\033[33m in the left.\033[0m", end="\n")
+        if left_unpaired or right_unpaired:
+            messaged = True
+
+    for left, right, episode in pairs:
+        with profile_stage("episode", episode=episode, left=left.name, right=right.name):
+            if episode is not None:
+                print(f"\033[1;37mComparing Episode {episode:02g}...\033[0m", end="\n")
+            message = guess_offset_files(left, right, args.timeline, get_keyframes_fps_)
+            if message:
+                messaged = True
+                if episode is not None:
+                    print(f"\r\033[1A\033[K\033[1;37mOffsets in Episode {episode:02g} between left reference \033[0m\"{left.name}\"\033[1;37m and right target \033[0m\"{right.name}\"\033[1;37m:\033[0m", end="\n")
+                elif len(pairs) > 1:
+                    print(f"\033[1;37mOffsets between left reference \033[0m\"{left.name}\"\033[1;37m and right target \033[0m\"{right.name}\"\033[1;37m:\033[0m", end="\n")
+                print(message, end="")
+            else:
+                if episode is not None:
+                    print("\r\033[1A\033[K", end="")
+
+    if executor is not None:
+        executor.shutdown()
 
-if not messaged:
-    print("No timing differences were detected. Left and right clips are aligned.", end="\n")
+    if not messaged:
+        print("No timing differences were detected. Left and right clips are aligned.", end="\n")
+    if args.profile is not None:
+        print(finish_profile(args.profile), end="")
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+# TimingOffset benchmark
+# Copyright (c) Akatsumekusa and contributors
+
+# ---------------------------------------------------------------------
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+# ---------------------------------------------------------------------
+
+# Measures the speed and accuracy of TimingOffset.py on synthetic episodes
+# with known offsets. Run it before and after changing the parsers or the
+# analysis, with the same --seed, and compare the two reports.
+
+import argparse
+import json
+import numpy as np
+from pathlib import Path
+import platform
+import os
+import sys
+import tempfile
+import time
+import typing
+
+sys.path.insert(0, Path(__file__).resolve().parent.as_posix())
+import TimingOffset
+from TimingOffset import Keyframes, Segment
+
+# A synthetic pair of clips. timeline is the true offset of right against
+# left for every frame of left, in the same form analyse_offset_timeline
+# returns.
+class Case(typing.NamedTuple):
+    name: str
+    left: Keyframes
+    right: Keyframes
+    timeline: list[Segment]
+    max_offset: int
+
+# Shot lengths in anime and live action are roughly lognormal with a
+# median of about 3 seconds.
+def generate_scene_cuts(rng: np.random.Generator, length: int) -> np.ndarray[int]:
+    shots = np.clip(rng.lognormal(np.log(72), 0.8, length // 24 + 16), 6, 2400).astype(np.int64)
+    cuts = np.cumsum(shots)
+    return cuts[cuts < length]
+
+# Encodes a clip the way x264 and x265 with variable GOP would. Most scene
+# cuts become keyframes, some flashes do too, and gaps longer than keyint
+# get a forced keyframe.
+def encode_keyframes(rng: np.random.Generator, cuts: np.ndarray[int], length: int, keyint: int, miss: float, extra: float) -> Keyframes:
+    frames = cuts[(cuts > 0) & (cuts < length) & (rng.random(cuts.shape) >= miss)]
+    frames = np.unique(np.concatenate(([0], frames, rng.integers(1, length, int(frames.shape[0] * extra)))))
+    forced = []
+    for start, end in zip(frames, np.append(frames[1:], length)):
+        forced.extend(range(start + keyint, end, keyint))
+    return Keyframes(np.unique(np.concatenate((frames, np.array(forced, dtype=np.int64)))).astype(np.int32), length)
+
+# Builds right from the same scene cuts as left. changes is a list of
+# (frame in left, offset from that frame on). Frames inserted in right
+# where the offset increases get their own scene cuts, and frames dropped
+# where it decreases take their cuts with them. With jitter, each keyframe
+# in right is placed up to jitter frames off its scene cut.
+def generate_case(rng: np.random.Generator, name: str, length: int, changes: list[tuple[int, int]], tail: int = 0, jitter: int = 0) -> Case:
+    cuts = generate_scene_cuts(rng, length)
+    left = encode_keyframes(rng, cuts, length, 250, 0.02, 0.02)
+
+    right_length = length + changes[-1][1] + tail
+    right_cuts = []
+    timeline = []
+    for i, (start, offset) in enumerate(changes):
+        end = changes[i + 1][0] if i + 1 < len(changes) else length
+        segment = cuts[(cuts >= start) & (cuts < end)] + offset
+        if i > 0 and offset > changes[i - 1][1]:
+            inserted = generate_scene_cuts(rng, offset - changes[i - 1][1]) + start + changes[i - 1][1]
+            segment = np.concatenate((inserted, segment))
+        right_cuts.append(segment[segment >= 0])
+        timeline.append(Segment(max(start, -offset), min(end, right_length - offset), offset))
+    if changes[0][1] > 0:
+        right_cuts.insert(0, generate_scene_cuts(rng, changes[0][1]))
+    if right_length > length + changes[-1][1]:
+        right_cuts.append(generate_scene_cuts(rng, tail) + length + changes[-1][1])
+    right_cuts = np.concatenate(right_cuts)
+    if jitter:
+        right_cuts = right_cuts + rng.integers(-jitter, jitter + 1, right_cuts.shape)
+    right = encode_keyframes(rng, right_cuts, right_length, 240, 0.08, 0.05)
+
+    max_offset = max(abs(offset) for _, offset in changes)
+    return Case(name, left, right, timeline, 240 if max_offset <= 240 else max(max_offset + 500, 1000))
+
+def generate_cases(rng: np.random.Generator, episodes: int, jitter: int = 0) -> list[Case]:
+    cases = []
+    for _ in range(episodes):
+        length = int(rng.integers(30000, 36000))
+        change = int(rng.integers(length // 4, length * 3 // 4))
+        cases.append(generate_case(rng, "aligned", length, [(0, 0)], jitter=jitter))
+        cases.append(generate_case(rng, "shift", length, [(0, int(rng.choice([-1, 1]) * rng.integers(1, 241)))], jitter=jitter))
+        cases.append(generate_case(rng, "wide shift", length, [(0, int(rng.choice([-1, 1]) * rng.integers(1000, 5001)))], jitter=jitter))
+        cases.append(generate_case(rng, "timing change", length, [(0, 0), (change, int(rng.integers(24, 241)))], jitter=jitter))
+        cases.append(generate_case(rng, "dropped frames", length, [(0, 0), (change, -int(rng.integers(1, 13)))], jitter=jitter))
+        cases.append(generate_case(rng, "length mismatch", length, [(0, 0)], int(rng.choice([-1, 1]) * rng.integers(73, 500)), jitter=jitter))
+    return cases
+
+def write_keyframe_format(path: Path, keyframes: Keyframes) -> None:
+    with path.open("w", encoding="utf-8", newline="\n") as f:
+        f.write("# keyframe format v1\nfps 0\n")
+        f.write("".join(f"{frame}\n" for frame in keyframes.frames))
+
+# Writes the video part of an lwi file as lsmas does, one Index line and
+# one Key line for every frame.
+def write_lwi(path: Path, keyframes: Keyframes) -> None:
+    key = np.zeros((keyframes.length,), dtype=bool)
+    key[keyframes.frames] = True
+    with path.open("w", encoding="utf-8", newline="\n") as f:
+        f.write("<LSMASHWorksIndexVersion=0.0.3.0>\n<LibavReaderIndexFile=6>\n<InputFilePath>synthetic.mkv</InputFilePath>\n<LibavReaderIndex=0x00000208,0,marker>\n")
+        f.write("".join(f"Index=0,POS={i * 4096},PTS={i * 1001},DTS={i * 1001},EDI=0\nKey={int(key[i])},Pic={1 if key[i] else 3},POC=0,Repeat=1,Field=0\n" for i in range(keyframes.length)))
+        f.write("</LibavReaderIndex>\n</LibavReaderIndexFile>\n")
+
+# The line by line readers TimingOffset.py used before it memory-mapped
+# index files, kept as a reference for the speed of the parsers.
+def read_keyframe_format_by_line(path: Path) -> list[int]:
+    lines = []
+    with path.open("r", encoding="utf-8") as f:
+        while True:
+            try:
+                line = f.readline()
+            except UnicodeDecodeError:
+                continue
+            if not line:
+                break
+
+            if line.startswith("#") or line.startswith("fps"):
+                continue
+
+            try:
+                lines.append(int(line.split()[0]))
+            except (IndexError, ValueError):
+                continue
+
+    return lines
+
+def read_lwi_by_line(path: Path) -> np.ndarray[bool]:
+    lines = []
+    with path.open("r", encoding="utf-8") as f:
+        while True:
+            try:
+                line = f.readline()
+            except UnicodeDecodeError:
+                continue
+            if not line:
+                break
+
+            if line.startswith("Key="):
+                lines.append(bool(int(line[4])))
+            else:
+                continue
+
+    return np.array(lines, dtype=bool)
+
+# Whether sections found the true offset in every section. A section
+# across a timing change may report either offset, or both, and a section
+# mostly outside the frames both clips share may report anything.
+def check_sections(case: Case, sections: list[TimingOffset.Section]) -> bool:
+    for section in sections:
+        overlaps = {segment.offset: min(segment.end, section.end) - max(segment.start, section.start) for segment in case.timeline}
+        if sum(overlap for overlap in overlaps.values() if overlap > 0) < (section.end - section.start) / 2:
+            continue
+        expected = {offset for offset, overlap in overlaps.items() if overlap > 0}
+        found = {offset.offset for offset in section.offsets}
+        if len(expected) == 1 and found != expected:
+            return False
+        if len(expected) > 1 and (not found or not found <= expected):
+            return False
+    return True
+
+# Whether timeline found the true offsets in order, with every timing
+# change placed within tolerance of the frames where it could be. Since
+# only keyframes are compared, a change can only be located somewhere
+# between the last keyframe matching the previous offset and the first
+# keyframe matching the next.
+def check_timeline(case: Case, timeline: list[Segment], tolerance: int) -> bool:
+    if [segment.offset for segment in timeline] != [segment.offset for segment in case.timeline]:
+        return False
+    for found, expected, previous in zip(timeline[1:], case.timeline[1:], case.timeline[:-1]):
+        before = case.left.frames[case.left.frames < expected.start]
+        before = before[np.isin(before + previous.offset, case.right.frames)]
+        after = case.left.frames[case.left.frames >= expected.start]
+        after = after[np.isin(after + expected.offset, case.right.frames)]
+        low = before[-1] + 1 if before.shape[0] else 0
+        high = after[0] if after.shape[0] else expected.end
+        if not low - tolerance <= found.start <= high + tolerance:
+            return False
+    return True
+
+def run_stage(stage: typing.Callable[[Case], bool], cases: list[Case], frames: typing.Callable[[Case], int]) -> dict:
+    correct = 0
+    failed = set()
+    total_frames = 0
+    elapsed = 0.0
+    for case in cases:
+        TimingOffset.max_offset = case.max_offset
+        start = time.perf_counter()
+        result = stage(case)
+        elapsed += time.perf_counter() - start
+        total_frames += frames(case)
+        if result:
+            correct += 1
+        else:
+            failed.add(case.name)
+    return {"cases": len(cases), "frames_per_second": total_frames / elapsed if elapsed else float("inf"), "accuracy": correct / len(cases), "failed": sorted(failed)}
+
+def benchmark(cases: list[Case], directory: Path, tolerance: int) -> dict[str, dict]:
+    for i, case in enumerate(cases):
+        write_keyframe_format(directory / f"{i}_left.txt", case.left)
+        write_keyframe_format(directory / f"{i}_right.txt", case.right)
+        write_lwi(directory / f"{i}_left.lwi", case.left)
+        write_lwi(directory / f"{i}_right.lwi", case.right)
+    index = {id(case): i for i, case in enumerate(cases)}
+    length = lambda case: min(case.left.length, case.right.length)
+    unrelated = cases[-1].left
+
+    results = {}
+    results["parse keyframe format"] = run_stage(
+        lambda case: np.array_equal(TimingOffset.get_keyframes_keyframe_format(directory / f"{index[id(case)]}_right.txt").frames, case.right.frames),
+        cases, lambda case: case.right.length)
+    results["parse lwi"] = run_stage(
+        lambda case: np.array_equal(TimingOffset.get_keyframes_lwi(directory / f"{index[id(case)]}_right.lwi").frames, case.right.frames),
+        cases, lambda case: case.right.length)
+    results["keyframe format by line"] = run_stage(
+        lambda case: np.array_equal(read_keyframe_format_by_line(directory / f"{index[id(case)]}_right.txt"), case.right.frames),
+        cases, lambda case: case.right.length)
+    results["lwi by line"] = run_stage(
+        lambda case: np.array_equal(np.flatnonzero(read_lwi_by_line(directory / f"{index[id(case)]}_right.lwi")), case.right.frames),
+        cases, lambda case: case.right.length)
+    results["compare length"] = run_stage(
+        lambda case: (TimingOffset.compare_length(case.left, case.right)[1] is not None) == (abs(case.left.length - case.right.length) > 72),
+        cases, length)
+    results["guess offset range"] = run_stage(
+        lambda case: check_sections(case, [TimingOffset.analyse_offset_range(case.left, case.right, (0, min(5754, length(case))))]),
+        cases, lambda case: min(5754, length(case)))
+    results["guess offset"] = run_stage(
+        lambda case: check_sections(case, TimingOffset.analyse_offset(case.left, case.right)),
+        cases, length)
+    results["timeline"] = run_stage(
+        lambda case: check_timeline(case, TimingOffset.analyse_offset_timeline(case.left, case.right), tolerance),
+        cases, length)
+    results["one vs many"] = run_stage(
+        lambda case: (alignments := TimingOffset.analyse_offset_many(case.left, [case.right, unrelated]))[0].offsets[:1] != [] and
+                     alignments[0].offsets[0].offset in {segment.offset for segment in case.timeline} and
+                     alignments[0].matched > alignments[1].matched,
+        cases[:-1], length)
+    return results
+
+def print_results(results: dict[str, dict]) -> None:
+    print(f"\033[1;37m{'Stage':<24}{'Cases':>8}{'Frames/s':>16}{'Accuracy':>12}\033[0m")
+    for stage, result in results.items():
+        colour = "\033[32m" if result["accuracy"] == 1 else "\033[33m" if result["accuracy"] >= 0.9 else "\033[31m"
+        print(f"{stage:<24}{result['cases']:>8}{result['frames_per_second']:>16,.0f}{colour}{result['accuracy']:>12.1%}\033[0m", end="")
+        if result["failed"]:
+            print(f"  \033[33mfailed on: {', '.join(result['failed'])}\033[0m", end="")
+        print()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="TimingOffset_benchmark", description="Measure the speed and accuracy of TimingOffset.py on synthetic keyframes with known offsets")
+    parser.add_argument("-n", "--episodes", type=int, default=4, help="Number of synthetic episodes to generate for each scenario (default: %(default)s)")
+    parser.add_argument("-s", "--seed", type=int, default=0, help="Seed for the synthetic episodes (default: %(default)s)")
+    parser.add_argument("--tolerance", type=int, default=48, help="Largest error in frames allowed for timing changes in timeline mode (default: %(default)s)")
+    parser.add_argument("--jitter", type=int, default=0, help="Place the keyframes of right clips up to this many frames off their scene cuts, and match them with a tolerance of as many frames (default: %(default)s)")
+    parser.add_argument("--keep", type=Path, help="Write the generated lwi and keyframe format files to this directory instead of a temporary one")
+    parser.add_argument("--json", type=Path, help="Also write the results to this JSON file")
+    args = parser.parse_args()
+
+    if platform.system() == "Windows":
+        os.system("")
+
+    cases = generate_cases(np.random.default_rng(args.seed), args.episodes, args.jitter)
+    TimingOffset.tolerance = args.jitter
+    if args.keep is not None:
+        args.keep.mkdir(parents=True, exist_ok=True)
+        results = benchmark(cases, args.keep, args.tolerance)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            results = benchmark(cases, Path(directory), args.tolerance)
+
+    print_results(results)
+    if args.json is not None:
+        with args.json.open("w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
@@ -36,10 +36,20 @@ if True:
 # |      something like                                               |
 # |      "https://nyaa.si/?page=rss&q=SubsPlease+Wonder+Egg+Priority&c=0_0&f=0".
     feed = ""
+# | To watch more than one feed, pass all the links in cli, or put    |
+# | them in a text file, one link per line, and pass the file with    |
+# | `--config`. All feeds are fetched at the same time.               |
 # | You can also set how often nyaa_notify.py should look for new     |
 # | updates in the feed in the update_interval field below in         |
 # | minutes. Akatsumekusa's default value is 3, or 3 minutes.         |
     update_interval = 3
+# | nyaa_notify.py learns when each feed usually updates from the     |
+# | entries it has seen, and only updates every update_interval       |
+# | around these times. Otherwise, every time a feed has no new       |
+# | entries, nyaa_notify.py waits twice as long before updating it    |
+# | again, up to the max_update_interval field below in minutes.      |
+# | Akatsumekusa's default value is 60, or an hour.                   |
+    max_update_interval = 60
 # | Note that Nyaa often has a delay between an item is published     |
 # | and it is being updated to the RSS feed. As an estimation, you    |
 # | can expect to receive a notification within (update_interval + 5) |
@@ -61,23 +71,74 @@ if True:
 # | value here in nyaa_notify.py is 1.                                |
     pings = 1
 # +-------------------------------------------------------------------+
+# | nyaa_notify.py remembers the entries it has notified you about in |
+# | a file, so that they are not notified again after a restart. You  |
+# | can set where the file is in the state field below. If left       |
+# | empty, the file is placed in your local app data folder on        |
+# | Windows, or in ~/.local/state on other systems.                   |
+    state = ""
+# | Entries are forgotten once they are older than the number of days |
+# | set in the remember field below, or older than traceback, which   |
+# | ever is longer. Akatsumekusa's default value is 7, or a week.     |
+    remember = 7
+# +-------------------------------------------------------------------+
+# | nyaa_notify.py shows a desktop notification with win10toast on    |
+# | Windows. On other systems, it only lists the new entries in the   |
+# | terminal as they are found. You can also send notifications       |
+# | elsewhere in the notify field below. "toast" shows a desktop      |
+# | notification, "stdout" rings the terminal bell and prints the     |
+# | notification below the list, and "webhook:" followed by a link    |
+# | posts it in JSON to the link. More than one can be set, for       |
+# | example ["toast", "webhook:http://localhost:8080/notify"].        |
+    notify = []
+# +-------------------------------------------------------------------+
+# | Instead of one search feed for every show, you can also watch a   |
+# | broad feed, such as every release from a group, and only be       |
+# | notified about the entries that match your rules. Write the rules |
+# | in a JSON file and set the file in the rules field below. Each    |
+# | rule is an object such as                                         |
+# |      {"name": "Frieren", "title": "Sousou no Frieren",            |
+# |       "resolution": [1080], "episodes": [1, 28],                  |
+# |       "max_size": "2 GiB"}.                                       |
+# | "title" is text the title must contain, ignoring case, and        |
+# | "regex" is a regular expression to search the title for instead.  |
+# | "resolution", "episodes", "min_size" and "max_size" are optional. |
+# | A rule with "exclude": true drops the entries it matches. An      |
+# | entry is notified if it matches any other rule, or if there are   |
+# | only exclude rules, if it doesn't match any of them.              |
+    rules = ""
+# +-------------------------------------------------------------------+
 # | These config values could be overwritten in cli. Use              |
 # | `./nyaa_notify.py --help` for more information.                   |
 # +-------------------------------------------------------------------+
 
 import argparse
+import asyncio
 from cjkwrap import cjkslices
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import email.utils
 from feedparser import parse
+import gzip
+import http.client
+import importlib.util
+import io
+import json
 import os
+import platform
+import queue
+import random
 import re
 import shutil
 import signal
+import sqlite3
 import sys
+import threading
 import time
-import win10toast
-
-toast = win10toast.ToastNotifier()
+import typing
+import urllib.parse
+import urllib.request
+from xml.etree import ElementTree
             
 pls_exit = False
 _times = 0
@@ -106,103 +167,604 @@ def nyaa_notify() -> None:
                                              the same url every times, or you prefer to directly double click the py file to run, open \
                                              nyaa_notify.py in a text editor and head to around line 21.")
     if feed:
-        parser.add_argument("url", help="URL for the RSS feed (set in nyaa_notify.py: \"" + feed + "\")", nargs="?", default=feed)
+        parser.add_argument("url", help="URLs for the RSS feeds (set in nyaa_notify.py: \"" + feed + "\")", nargs="*")
     else:
-        parser.add_argument("url", help="URL for the RSS feed")
+        parser.add_argument("url", help="URLs for the RSS feeds", nargs="*")
+    parser.add_argument("-c", "--config", help="read more URLs for the RSS feeds from this file, one URL per line")
     parser.add_argument("-i", "--interval", help="set the update interval in minutes (default: " + str(update_interval) + ")", type=float, default=update_interval)
+    parser.add_argument("-m", "--max-interval", help="set the longest update interval in minutes when no new entries are expected (default: " + str(max_update_interval) + ")", type=float, default=max_update_interval)
     parser.add_argument("-t", "--traceback", help="set traceback in minutes (default: " + str(traceback) + ")", type=float, default=traceback)
     parser.add_argument("-p", "--pings", help="set the number of notifications you want to receive for each entry (default: " + str(pings) + ")", type=int, default=pings)
+    parser.add_argument("-s", "--state", help="set the file to remember notified entries in (default: \"" + (state or get_default_state()) + "\")", default=state or get_default_state())
+    parser.add_argument("-n", "--notify", help="send notifications with toast, stdout or webhook:URL, can be given more than once (default: " + (", ".join(notify or get_default_notify()) or "none") + ")", action="append")
+    parser.add_argument("-R", "--rules", help="only notify entries matching the rules in this JSON file" + (" (set in nyaa_notify.py: \"" + rules + "\")" if rules else ""), default=rules or None)
+    parser.add_argument("-r", "--remember", help="set how long to remember notified entries in days (default: " + str(remember) + ")", type=float, default=remember)
     
     if pls_exit:
         return
     args = parser.parse_args()
 
-    rss(args.url, args.interval * 60, args.traceback, args.pings)
+    rss_urls = args.url
+    if args.config:
+        with open(args.config, encoding="utf-8") as f:
+            rss_urls += [line.strip() for line in f if line.strip() and not line.strip().startswith("#")]
+    if not rss_urls and feed:
+        rss_urls = [feed]
+    if not rss_urls:
+        parser.error("no URL for the RSS feed given")
+
+    try:
+        backends = [get_backend(backend) for backend in args.notify or notify or get_default_notify()]
+        matcher = RuleMatcher(load_rules(args.rules)) if args.rules else None
+    except (ValueError, OSError) as e:
+        parser.error(str(e))
 
-def rss(rss_url: str, interval: float, traceback: float, pings: int) -> None:
-    traceback = datetime.now() - timedelta(minutes=traceback)
+    notifications = NotificationQueue(backends)
+    try:
+        rss(list(dict.fromkeys(rss_urls)), args.interval * 60, max(args.max_interval, args.interval) * 60, args.traceback, args.pings, EntryStore(args.state), args.remember, notifications, matcher)
+    finally:
+        notifications.close()
+
+# Published times are read as naive datetimes in UTC, so the times they
+# are compared with are too.
+def utc_now() -> datetime:
+    return datetime(*time.gmtime()[:6])
+
+# datetime.timestamp() would take a naive datetime to be in local time.
+def utc_timestamp(value: datetime) -> float:
+    return value.replace(tzinfo=timezone.utc).timestamp()
+
+def rss(rss_urls: list[str], interval: float, max_interval: float, traceback: float, pings: int, store: "EntryStore", remember: float, notifications: "NotificationQueue", matcher: typing.Optional["RuleMatcher"]) -> None:
+    remember = timedelta(days=remember) if timedelta(days=remember) > timedelta(minutes=traceback) else timedelta(minutes=traceback)
+    traceback = utc_now() - timedelta(minutes=traceback)
+    client = FeedClient()
+    scheduler = PollScheduler(store, rss_urls, interval, max_interval)
     if pls_exit:
         return
-    rss_notify(rss_url, traceback, datetime.now(), pings)
+    store.evict(utc_now() - remember)
+    rss_notify(client, store, notifications, matcher, scheduler, scheduler.due(), traceback, pings)
 
     while True:
         signal.signal(signal.SIGINT, signal.default_int_handler)
         try:
             if pls_exit:
                 return
-            time.sleep(interval)
+            time.sleep(scheduler.wait())
         except KeyboardInterrupt:
             interrupt(times=-2)
         signal.signal(signal.SIGINT, interrupt)
 
-        rss_notify(rss_url,
-                   datetime.now() - timedelta(minutes=30) if datetime.now() - timedelta(minutes=30) > traceback else traceback,
-                   datetime.now(),
+        # A feed may not have been updated for up to max_interval.
+        store.evict(utc_now() - remember)
+        rss_notify(client, store, notifications, matcher, scheduler, scheduler.due(),
+                   utc_now() - timedelta(minutes=30, seconds=max_interval) if utc_now() - timedelta(minutes=30, seconds=max_interval) > traceback else traceback,
                    pings)
 
-notified_entries = {}
-# It is always confusing what before and after means. If we plot these
-# two variables in a timeline:
-# notify_after ----> entries to notify ----> notify_before ----> year 2029
-# assuming you won't be using this script as far into the future as
-# 2029 (
-def rss_notify(rss_url: str, notify_after: datetime, notify_before: datetime, pings: int) -> None:
-    # notified_entries[entry_title: str] = [entry_url: str, ping: int]
-    global notified_entries
+# A small HTTP client that keeps the connection to each host alive between
+# polls, so that watching many feeds on Nyaa doesn't open a new TLS
+# connection for every feed every time. Requests are blocking and are run
+# on the executor, which also caps how many feeds are fetched at once.
+class FeedClient:
+    def __init__(self, max_connections: int = 4, timeout: float = 30) -> None:
+        self.executor = ThreadPoolExecutor(max_connections)
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def connect(self, scheme: str, netloc: str) -> tuple[http.client.HTTPConnection, bool]:
+        with self.lock:
+            if self.idle.get((scheme, netloc)):
+                return self.idle[(scheme, netloc)].pop(), True
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=self.timeout), False
+        else:
+            return http.client.HTTPConnection(netloc, timeout=self.timeout), False
+
+    # Returns the status, headers and decompressed body of the response,
+    # following up to 5 redirects.
+    def get(self, url: str, headers: dict[str, str], redirects: int = 5) -> tuple[int, http.client.HTTPMessage, bytes]:
+        split = urllib.parse.urlsplit(url)
+        path = (split.path or "/") + ("?" + split.query if split.query else "")
+        headers = {"User-Agent": "nyaa_notify.py", "Accept-Encoding": "gzip", **headers}
+
+        connection, reused = self.connect(split.scheme, split.netloc)
+        try:
+            connection.request("GET", path, headers=headers)
+            response = connection.getresponse()
+            body = response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            # The server may have closed an idle connection in the meantime.
+            if reused:
+                return self.get(url, headers, redirects)
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            with self.lock:
+                self.idle.setdefault((split.scheme, split.netloc), []).append(connection)
+
+        if response.status in (301, 302, 303, 307, 308) and response.getheader("Location") and redirects > 0:
+            return self.get(urllib.parse.urljoin(url, response.getheader("Location")), headers, redirects - 1)
+        if response.getheader("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+        return response.status, response.headers, body
+
+# feed_validators[rss_url] = [etag: str, last_modified: str]
+# They are sent back with the next request for the feed so that the server
+# can answer 304 Not Modified without sending the feed again if it hasn't
+# changed, in which case the feed is not parsed either.
+# Returns the entries of the feed newer than its watermark, or None if it
+# hasn't changed or couldn't be fetched, together with the seconds the
+# server asked to wait before the next request in Retry-After, if any.
+feed_validators = {}
+def fetch_feed(client: FeedClient, rss_url: str) -> tuple[typing.Optional[list["FeedEntry"]], typing.Optional[float]]:
+    headers = {}
+    etag, last_modified = feed_validators.get(rss_url, [None, None])
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    try:
+        status, response_headers, body = client.get(rss_url, headers)
+    except (http.client.HTTPException, OSError) as e:
+        print("[nyaa_notify] Failed to fetch " + rss_url + ": " + str(e), flush=True)
+        return None, None
+    retry_after = parse_retry_after(response_headers.get("Retry-After"))
+    if status == 304:
+        return None, retry_after
+    if status != 200:
+        print("[nyaa_notify] Failed to fetch " + rss_url + ": HTTP " + str(status) + (", retrying after " + str(round(retry_after)) + " seconds" if retry_after else ""), flush=True)
+        return None, retry_after
+
+    feed_validators[rss_url] = [response_headers.get("ETag"), response_headers.get("Last-Modified")]
+    return read_feed_entries(body, response_headers, feed_watermarks.get(rss_url)), retry_after
+
+# Retry-After is either a number of seconds or an HTTP date.
+def parse_retry_after(retry_after: typing.Optional[str]) -> typing.Optional[float]:
+    if not retry_after:
+        return None
+    if retry_after.strip().isdigit():
+        return float(retry_after)
+    try:
+        return max((email.utils.parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+# An entry in a feed. key is the infohash, or the guid or title for feeds
+# other than Nyaa's, and published is in UTC. summary is kept as is and
+# only searched for the link to the entry once the entry is known to be
+# new.
+class FeedEntry(typing.NamedTuple):
+    key: str
+    title: str
+    link: str
+    summary: str
+    published: datetime
+    size: typing.Optional[str]
+
+# feed_watermarks[rss_url] = [entry_key: str, published: datetime] of the
+# newest entry seen in the feed. Feeds list the newest entries first, so
+# reading stops at the first entry that is the watermark or older.
+feed_watermarks = {}
+nyaa_namespace = "{https://nyaa.si/xmlns/nyaa}"
+def is_past_watermark(key: str, published: datetime, watermark: typing.Optional[list]) -> bool:
+    return watermark is not None and (key == watermark[0] or published < watermark[1])
+
+# Reads the items of an RSS 2.0 feed one by one with iterparse, and stops
+# at the watermark, so that an update with nothing new only parses the
+# first item. Feeds that are not RSS 2.0, such as Atom feeds, or that are
+# malformed, are parsed whole with feedparser instead.
+def read_feed_entries(body: bytes, response_headers: http.client.HTTPMessage, watermark: typing.Optional[list]) -> list[FeedEntry]:
+    entries = []
+    root = None
+    try:
+        for event, element in ElementTree.iterparse(io.BytesIO(body), events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = element
+                    if root.tag != "rss":
+                        return read_feed_entries_feedparser(body, response_headers, watermark)
+                continue
+            if element.tag != "item":
+                continue
+            published = email.utils.parsedate_tz(element.findtext("pubDate") or "")
+            if published is None:
+                element.clear()
+                continue
+            published = datetime(*time.gmtime(email.utils.mktime_tz(published))[:6])
+            title = element.findtext("title") or ""
+            key = element.findtext(nyaa_namespace + "infoHash") or element.findtext("guid") or title
+            if is_past_watermark(key, published, watermark):
+                break
+            entries.append(FeedEntry(key, title, element.findtext("link") or "", element.findtext("description") or "", published, element.findtext(nyaa_namespace + "size")))
+            element.clear()
+    except ElementTree.ParseError:
+        return read_feed_entries_feedparser(body, response_headers, watermark)
+    return entries
+
+def read_feed_entries_feedparser(body: bytes, response_headers: http.client.HTTPMessage, watermark: typing.Optional[list]) -> list[FeedEntry]:
+    entries = []
+    for entry in parse(body, response_headers={key.lower(): value for key, value in response_headers.items()}).entries:
+        if not entry.get("published_parsed"):
+            continue
+        published = datetime(entry.published_parsed[0], entry.published_parsed[1], entry.published_parsed[2],
+                             entry.published_parsed[3], entry.published_parsed[4], entry.published_parsed[5])
+        key = entry.get("nyaa_infohash") or entry.get("id") or entry.title
+        if is_past_watermark(key, published, watermark):
+            break
+        entries.append(FeedEntry(key, entry.title, entry.get("link", ""), entry.get("summary", ""), published, entry.get("nyaa_size")))
+    return entries
+
+async def fetch_feeds(client: FeedClient, rss_urls: list[str]) -> list:
+    loop = asyncio.get_running_loop()
+    return await asyncio.gather(*[loop.run_in_executor(client.executor, fetch_feed, client, rss_url) for rss_url in rss_urls])
+
+# A rule from the rules file. title is casefolded. episodes is the first
+# and last episode, and min_size and max_size are in bytes.
+class Rule(typing.NamedTuple):
+    name: str
+    title: typing.Optional[str]
+    regex: typing.Optional[str]
+    exclude: bool
+    resolution: list[int]
+    episodes: typing.Optional[tuple[float, float]]
+    min_size: typing.Optional[float]
+    max_size: typing.Optional[float]
+
+size_units = {"B": 1, "KB": 1e3, "MB": 1e6, "GB": 1e9, "TB": 1e12, "KIB": 1024, "MIB": 1024 ** 2, "GIB": 1024 ** 3, "TIB": 1024 ** 4}
+def parse_size(text: str) -> float:
+    match = re.fullmatch(r"\s*([0-9]+(?:\.[0-9]+)?)\s*([KMGT]?I?B)\s*", text, re.IGNORECASE)
+    if not match or match.group(2).upper() not in size_units:
+        raise ValueError("invalid size \"" + text + "\"")
+    return float(match.group(1)) * size_units[match.group(2).upper()]
+
+def load_rules(path: str) -> list[Rule]:
+    with open(path, encoding="utf-8") as f:
+        try:
+            items = json.load(f)
+        except json.JSONDecodeError as e:
+            raise ValueError("invalid rules file " + path + ": " + str(e))
+    if not isinstance(items, list):
+        raise ValueError("rules file " + path + " must contain a list of rules")
+
+    loaded = []
+    for i, item in enumerate(items):
+        if not isinstance(item, dict):
+            raise ValueError("rule " + str(i + 1) + " in rules file " + path + " must be an object")
+        name = str(item.get("name", item.get("title") or item.get("regex") or "rule " + str(i + 1)))
+        unknown = set(item) - {"name", "title", "regex", "exclude", "resolution", "episodes", "min_size", "max_size"}
+        if unknown:
+            raise ValueError("unknown field \"" + sorted(unknown)[0] + "\" in rule \"" + name + "\"")
+        if item.get("regex"):
+            try:
+                re.compile(item["regex"])
+            except re.error as e:
+                raise ValueError("invalid regex in rule \"" + name + "\": " + str(e))
+        resolution = item.get("resolution", [])
+        episodes = item.get("episodes")
+        if isinstance(episodes, str):
+            try:
+                episodes = [float(episode) for episode in episodes.split("-", 1)]
+            except ValueError:
+                episodes = None
+        elif isinstance(episodes, (int, float)) and not isinstance(episodes, bool):
+            episodes = [episodes]
+        elif episodes is not None and not isinstance(episodes, list):
+            episodes = None
+        if item.get("episodes") is not None and (episodes is None or len(episodes) not in (1, 2) or
+                                                   not all(isinstance(episode, (int, float)) and not isinstance(episode, bool) for episode in episodes)):
+            raise ValueError("episodes in rule \"" + name + "\" must be a number, a range such as \"1-12\", or a list of one or two numbers")
+        if episodes is not None:
+            episodes = (episodes[0], episodes[-1])
+        loaded.append(Rule(name, item["title"].casefold() if item.get("title") else None, item.get("regex") or None, bool(item.get("exclude", False)),
+                           [int(value) for value in (resolution if isinstance(resolution, list) else [resolution])],
+                           episodes,
+                           parse_size(item["min_size"]) if item.get("min_size") else None,
+                           parse_size(item["max_size"]) if item.get("max_size") else None))
+    return loaded
+
+resolution_match = re.compile(r"(?<![0-9])(?:[0-9]{3,4}x)?([0-9]{3,4})[pi](?![a-z])|(?<![0-9])[0-9]{3,4}x([0-9]{3,4})(?![0-9])", re.IGNORECASE)
+episode_match = re.compile(r"(?: - |(?<![a-z])E(?:P|pisode)? ?|#)([0-9]{1,4}(?:\.[0-9])?)(?:v[0-9])?(?![0-9])", re.IGNORECASE)
+inline_flags_match = re.compile(r"\(\?[aiLmsux]+\)")
+backreference_match = re.compile(r"(?<!\\)(?:\\\\)*\\[1-9]|\(\?\(")
+
+# Matches entries against all rules at once. The title texts of all rules
+# are compiled into one Aho-Corasick automaton, so the cost for each
+# entry depends on the length of its title and not on the number of
+# rules. The regexes of all rules are joined into one regex that is
+# searched first, and only if it is found are the regexes searched one by
+# one to tell which rules it was. Regexes with inline flags, named groups
+# or numeric backreferences would break or be broken by the others when
+# joined, and are always searched on their own instead. Only the rules
+# found by these are checked further.
+class RuleMatcher:
+    def __init__(self, rules: list[Rule]) -> None:
+        self.rules = rules
+        self.includes = any(not rule.exclude for rule in rules)
+
+        # goto[state][character] = state, and output[state] lists the
+        # rules whose title ends at state.
+        self.goto = [{}]
+        self.output = [[]]
+        for i, rule in enumerate(rules):
+            if rule.title:
+                state = 0
+                for character in rule.title:
+                    if character not in self.goto[state]:
+                        self.goto.append({})
+                        self.output.append([])
+                        self.goto[state][character] = len(self.goto) - 1
+                    state = self.goto[state][character]
+                self.output[state].append(i)
+        self.fail = [0] * len(self.goto)
+        states = list(self.goto[0].values())
+        for state in states:
+            for character, next_state in self.goto[state].items():
+                states.append(next_state)
+                fail = self.fail[state]
+                while fail and character not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[next_state] = self.goto[fail].get(character, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+        self.joined = []
+        self.separate = []
+        for i, rule in enumerate(rules):
+            if rule.regex:
+                regex = re.compile(rule.regex, re.IGNORECASE)
+                if inline_flags_match.match(rule.regex) or regex.groupindex or backreference_match.search(rule.regex):
+                    self.separate.append((i, regex))
+                else:
+                    self.joined.append((i, regex))
+        self.regex = re.compile("|".join("(?:" + regex.pattern + ")" for i, regex in self.joined), re.IGNORECASE) if self.joined else None
+        self.always = [i for i, rule in enumerate(rules) if not rule.title and not rule.regex]
+
+    # Returns the indices of the rules whose title or regex is found in text.
+    def search(self, text: str) -> set[int]:
+        found = set(self.always)
+        state = 0
+        for character in text.casefold():
+            while state and character not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(character, 0)
+            found.update(self.output[state])
+        if self.regex and self.regex.search(text):
+            found.update(i for i, regex in self.joined if regex.search(text))
+        found.update(i for i, regex in self.separate if regex.search(text))
+        return found
+
+    # Returns the first include rule matching the entry, or a rule with
+    # no condition if there are only exclude rules and none of them match.
+    def match(self, entry_title: str, entry_size: typing.Optional[str] = None) -> typing.Optional[Rule]:
+        resolution = None
+        episode = None
+        size = None
+        matched = None
+        for i in sorted(self.search(entry_title)):
+            rule = self.rules[i]
+            if rule.resolution:
+                if resolution is None:
+                    resolution = [int(group) for match in resolution_match.finditer(entry_title) for group in match.groups() if group]
+                if not set(rule.resolution) & set(resolution):
+                    continue
+            if rule.episodes:
+                if episode is None:
+                    episode = episode_match.search(entry_title)
+                    episode = float(episode.group(1)) if episode else float("nan")
+                if not rule.episodes[0] <= episode <= rule.episodes[1]:
+                    continue
+            if rule.min_size is not None or rule.max_size is not None:
+                if size is None:
+                    try:
+                        size = parse_size(entry_size) if entry_size else float("nan")
+                    except ValueError:
+                        size = float("nan")
+                if not (rule.min_size is None or size >= rule.min_size) or not (rule.max_size is None or size <= rule.max_size):
+                    continue
+            if rule.exclude:
+                return None
+            elif matched is None:
+                matched = rule
+        if matched is None and not self.includes:
+            return Rule("", None, None, False, [], None, None, None)
+        return matched
+
+def get_default_state() -> str:
+    if platform.system() == "Windows" and "LOCALAPPDATA" in os.environ:
+        return os.path.join(os.environ["LOCALAPPDATA"], "nyaa_notify", "state.sqlite3")
+    elif "XDG_STATE_HOME" in os.environ:
+        return os.path.join(os.environ["XDG_STATE_HOME"], "nyaa_notify", "state.sqlite3")
+    else:
+        return os.path.join(os.path.expanduser("~"), ".local", "state", "nyaa_notify", "state.sqlite3")
+
+# The entries seen in the feeds, kept in an SQLite database. Entries are
+# keyed by their infohash, or their guid or title for feeds other than
+# Nyaa's. remaining is the number of notifications still to be sent for
+# an entry, and the partial index on it lets each update find the pending
+# entries without going through every entry ever seen. Entries are listed
+# in the order they were first seen.
+class EntryStore:
+    def __init__(self, path: str) -> None:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (
+                id INTEGER PRIMARY KEY,
+                key TEXT NOT NULL UNIQUE,
+                title TEXT NOT NULL,
+                url TEXT NOT NULL,
+                published REAL NOT NULL,
+                remaining INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS entries_pending ON entries (id) WHERE remaining > 0;
+            CREATE INDEX IF NOT EXISTS entries_published ON entries (published);
+            CREATE TABLE IF NOT EXISTS releases (
+                url TEXT NOT NULL,
+                published REAL NOT NULL,
+                PRIMARY KEY (url, published)
+            ) WITHOUT ROWID;
+        """)
+
+    # Returns True if the entry hasn't been seen before.
+    def add(self, key: str, title: str, url: str, published: datetime, pings: int) -> bool:
+        return self.connection.execute("INSERT OR IGNORE INTO entries (key, title, url, published, remaining) VALUES (?, ?, ?, ?, ?)",
+                                       (key, title, url, utc_timestamp(published), pings)).rowcount == 1
 
+    # Returns [key, title, url] of each entry with notifications to send.
+    def pending(self) -> list[list[str]]:
+        return [list(row) for row in self.connection.execute("SELECT key, title, url FROM entries WHERE remaining > 0 ORDER BY id")]
+
+    def notified(self, key: str) -> None:
+        self.connection.execute("UPDATE entries SET remaining = remaining - 1 WHERE key = ?", (key,))
+
+    # The time each new entry was published in a feed is kept for
+    # release_history weeks for PollScheduler, after the entry itself is
+    # evicted.
+    def add_release(self, rss_url: str, published: datetime) -> None:
+        self.connection.execute("INSERT OR IGNORE INTO releases VALUES (?, ?)", (rss_url, utc_timestamp(published)))
+
+    def releases(self, rss_url: str) -> list[float]:
+        return [row[0] for row in self.connection.execute("SELECT published FROM releases WHERE url = ?", (rss_url,))]
+
+    def evict(self, before: datetime) -> None:
+        self.connection.execute("DELETE FROM entries WHERE published < ?", (utc_timestamp(before),))
+        self.connection.execute("DELETE FROM releases WHERE published < ?", (utc_timestamp(utc_now() - timedelta(weeks=release_history)),))
+        self.connection.commit()
+
+    def commit(self) -> None:
+        self.connection.commit()
+
+release_history = 8
+# Schedules the next update of each feed. A feed is expected to update
+# around the same time of the week as it has before, from 15 minutes
+# before to 2 hours after the time of week of each past release. Within
+# these windows, the feed is updated every interval. Outside of them,
+# the wait doubles every time the feed has no new entries, up to
+# max_interval, and is cut short when the next window opens. A new entry
+# resets the wait to interval. Every wait is randomised by 20% so that
+# feeds don't stay in step, and is never shorter than the Retry-After
+# sent by the server. A 429 without Retry-After is treated as an update
+# with no new entries.
+class PollScheduler:
+    week = 7 * 24 * 60 * 60
+    window = (15 * 60, 2 * 60 * 60)
+
+    def __init__(self, store: "EntryStore", rss_urls: list[str], interval: float, max_interval: float) -> None:
+        self.store = store
+        self.interval = interval
+        self.max_interval = max_interval
+        self.waits = {rss_url: interval for rss_url in rss_urls}
+        self.next_updates = {rss_url: time.time() for rss_url in rss_urls}
+
+    # Returns the feeds to update now.
+    def due(self) -> list[str]:
+        now = time.time()
+        return [rss_url for rss_url, next_update in self.next_updates.items() if next_update <= now]
+
+    # Returns the seconds until the next feed is due.
+    def wait(self) -> float:
+        return max(min(self.next_updates.values()) - time.time(), 0)
+
+    # Returns the seconds until the next release window of the feed opens,
+    # or 0 if it is open now.
+    def until_window(self, rss_url: str) -> float:
+        releases = self.store.releases(rss_url)
+        if not releases:
+            return float("inf")
+        now = time.time()
+        opened = [(now - release + self.window[0]) % self.week for release in releases]
+        if min(opened) <= self.window[0] + self.window[1]:
+            return 0
+        return self.week - max(opened)
+
+    def update(self, rss_url: str, updated: bool, retry_after: typing.Optional[float]) -> None:
+        if updated:
+            self.waits[rss_url] = self.interval
+        else:
+            self.waits[rss_url] = min(self.waits[rss_url] * 2, self.max_interval)
+
+        until_window = self.until_window(rss_url)
+        if until_window == 0:
+            wait = self.interval
+        else:
+            wait = min(self.waits[rss_url], max(until_window, self.interval))
+        wait *= random.uniform(0.8, 1.2)
+        if retry_after is not None:
+            wait = max(wait, retry_after)
+        self.next_updates[rss_url] = time.time() + wait
+
+# Entries published from notify_after onwards are notified. There is no
+# upper bound, so an entry that looks like it is from the future because
+# the clock here is behind is notified right away instead of being
+# skipped. The watermark of a feed is only moved to entries that were
+# considered.
+def rss_notify(client: FeedClient, store: EntryStore, notifications: "NotificationQueue", matcher: typing.Optional["RuleMatcher"], scheduler: "PollScheduler", rss_urls: list[str], notify_after: datetime, pings: int) -> None:
     signal.signal(signal.SIGINT, signal.default_int_handler)
     try:
         if pls_exit:
             return
-        feed = parse(rss_url)
+        feeds = asyncio.run(fetch_feeds(client, rss_urls))
     except KeyboardInterrupt:
         interrupt(times = 2)
         if pls_exit:
             return
     signal.signal(signal.SIGINT, interrupt)
 
-    for entry in feed.entries:
-        if notify_after <= datetime(entry.published_parsed[0], entry.published_parsed[1], entry.published_parsed[2],
-                                    entry.published_parsed[3], entry.published_parsed[4], entry.published_parsed[5]
-                                    ) <= notify_before:
-            if entry.title not in notified_entries:
+    new_entries = []
+    for rss_url, (entries, retry_after) in zip(rss_urls, feeds):
+        updated = False
+        watermark = None
+        for entry in entries or []:
+            if notify_after <= entry.published:
+                if watermark is None:
+                    watermark = [entry.key, entry.published]
+                if matcher and not matcher.match(entry.title, entry.size):
+                    continue
                 entry_url = ""
-                if hasattr(entry, "summary"):
-                    entry_url = re.search("(?<=\\\")(?=http\\:\\/\\/|https\\:\\/\\/).*?(?=\\\")", entry.summary).group(0)
-                if not entry_url and hasattr(entry, "link"):
-                    entry_url = entry.link
+                if entry.summary:
+                    entry_url = re.search("(?<=\\\")(?=http\\:\\/\\/|https\\:\\/\\/).*?(?=\\\")", entry.summary)
+                    entry_url = entry_url.group(0) if entry_url else ""
                 if not entry_url:
-                    entry_url = ""
-                notified_entries[entry.title] = [entry_url, 0]
+                    entry_url = entry.link
+                if store.add(entry.key, entry.title, entry_url, entry.published, pings):
+                    new_entries.append([entry.title, entry_url])
+                    store.add_release(rss_url, entry.published)
+                    updated = True
+        if watermark:
+            feed_watermarks[rss_url] = watermark
+        scheduler.update(rss_url, updated, retry_after)
+    store.commit()
     
     if pls_exit:
         return
-    print_notify(notified_entries)
+    print_notify(new_entries)
     if pls_exit:
         return
-    toast_notify_and_update_dict(notified_entries, pings)
+    queue_notify_and_update_store(store, notifications)
 
-def print_notify(notify_entries: dict[list[str, int]]) -> None:
+# notify_entries = [[entry_title: str, entry_url: str], ...]
+def print_notify(notify_entries: list[list[str]]) -> None:
     feed_updated_showed = False
     
-    for entry_title in notify_entries:
-        if notify_entries[entry_title][1] == 0:
-            if notify_entries[entry_title][0]:
-                if not feed_updated_showed:
-                    print("[nyaa_notify] Feed updated:")
-                    print("[nyaa_notify] " + "-" * (shutil.get_terminal_size((80, 24))[0] - 14))
-                    feed_updated_showed = True
-                print("[nyaa_notify] \033[1m" +
-                      "\033[0m\n[nyaa_notify] \033[1m".join(cjk_warp(entry_title, shutil.get_terminal_size((80, 24))[0] - 14)) +
-                      "\033[0m")
-                print("[nyaa_notify] " + 
-                      "\n[nyaa_notify] ".join(cjk_warp(notify_entries[entry_title][0], shutil.get_terminal_size((80, 24))[0] - 14)))
-                print("[nyaa_notify] " + "-" * (shutil.get_terminal_size((80, 24))[0] - 14), flush=True)
-            else:
-                if not feed_updated_showed:
-                    print("[nyaa_notify] Feed updated:")
-                    feed_updated_showed = True
-                print("[nyaa_notify] " + entry_title, flush=True)
+    for entry_title, entry_url in notify_entries:
+        if entry_url:
+            if not feed_updated_showed:
+                print("[nyaa_notify] Feed updated:")
+                print("[nyaa_notify] " + "-" * (shutil.get_terminal_size((80, 24))[0] - 14))
+                feed_updated_showed = True
+            print("[nyaa_notify] \033[1m" +
+                  "\033[0m\n[nyaa_notify] \033[1m".join(cjk_warp(entry_title, shutil.get_terminal_size((80, 24))[0] - 14)) +
+                  "\033[0m")
+            print("[nyaa_notify] " + 
+                  "\n[nyaa_notify] ".join(cjk_warp(entry_url, shutil.get_terminal_size((80, 24))[0] - 14)))
+            print("[nyaa_notify] " + "-" * (shutil.get_terminal_size((80, 24))[0] - 14), flush=True)
+        else:
+            if not feed_updated_showed:
+                print("[nyaa_notify] Feed updated:")
+                feed_updated_showed = True
+            print("[nyaa_notify] " + entry_title, flush=True)
 
 def cjk_warp(text: str, len: int) -> list[str]:
     l = []
@@ -212,31 +774,132 @@ def cjk_warp(text: str, len: int) -> list[str]:
         text = text.lstrip()
     return l
 
-def toast_notify_and_update_dict(notify_entries: dict[list[str, int]], pings: int) -> None:
-    for entry_title in notify_entries:
-        if notify_entries[entry_title][1] < pings:
-            # Toast notify
-            for _ in range(3):
+def queue_notify_and_update_store(store: EntryStore, notifications: "NotificationQueue") -> None:
+    for entry_key, entry_title, entry_url in store.pending():
+        notifications.put(entry_title, entry_url)
+        store.notified(entry_key)
+    store.commit()
+
+# Backends deliver a notification of one or more entries. entries is
+# [[entry_title: str, entry_url: str], ...].
+class ToastBackend:
+    def __init__(self) -> None:
+        import win10toast
+        self.toast = win10toast.ToastNotifier()
+
+    def send(self, title: str, message: str, entries: list[list[str]]) -> None:
+        self.toast.show_toast(title, message)
+
+class StdoutBackend:
+    def send(self, title: str, message: str, entries: list[list[str]]) -> None:
+        print("\a[nyaa_notify] \033[1m" + title + "\033[0m\n[nyaa_notify] " + "\n[nyaa_notify] ".join(message.split("\n")), flush=True)
+
+# Posts {"title": str, "message": str, "entries": [{"title": str, "url": str}, ...]}.
+class WebhookBackend:
+    def __init__(self, url: str, timeout: float = 10) -> None:
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, title: str, message: str, entries: list[list[str]]) -> None:
+        data = json.dumps({"title": title, "message": message, "entries": [{"title": entry_title, "url": entry_url} for entry_title, entry_url in entries]}).encode("utf-8")
+        request = urllib.request.Request(self.url, data=data, headers={"Content-Type": "application/json", "User-Agent": "nyaa_notify.py"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+# Keeps every notification in notifications instead of delivering it.
+class SinkBackend:
+    def __init__(self) -> None:
+        self.notifications = []
+
+    def send(self, title: str, message: str, entries: list[list[str]]) -> None:
+        self.notifications.append([title, message, entries])
+
+# print_notify already lists new entries in the terminal, so there is no
+# notification by default where toasts are not available.
+def get_default_notify() -> list[str]:
+    return ["toast"] if importlib.util.find_spec("win10toast") is not None else []
+
+def get_backend(name: str):
+    if name == "toast":
+        if importlib.util.find_spec("win10toast") is None:
+            raise ValueError("toast notifications require win10toast, which is not installed")
+        return ToastBackend()
+    elif name == "stdout":
+        return StdoutBackend()
+    elif name.startswith("webhook:"):
+        return WebhookBackend(name[len("webhook:"):])
+    else:
+        raise ValueError("unknown notification backend \"" + name + "\"")
+
+# Notifications are delivered by a background thread so that a slow
+# backend, such as a toast that blocks for as long as it is shown, doesn't
+# hold up the next update. Entries queued within batch_delay seconds of
+# each other are coalesced into one notification, and notifications are
+# sent at most once every rate_limit seconds. A failed delivery is retried
+# up to 3 times.
+class NotificationQueue:
+    def __init__(self, backends: list, rate_limit: float = 5, batch_delay: float = 2, batch_size: int = 5) -> None:
+        self.backends = backends
+        self.rate_limit = rate_limit
+        self.batch_delay = batch_delay
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, entry_title: str, entry_url: str) -> None:
+        self.queue.put([entry_title, entry_url])
+
+    # Sends the notifications still in the queue, waiting for at most
+    # timeout seconds.
+    def close(self, timeout: float = 10) -> None:
+        self.queue.put(None)
+        self.thread.join(timeout)
+
+    def run(self) -> None:
+        last_sent = -self.rate_limit
+        closed = False
+        while not closed:
+            entries = [self.queue.get()]
+            if entries[0] is None:
+                return
+            deadline = time.monotonic() + self.batch_delay
+            while True:
                 try:
-                    toast.show_toast("Feed updated", entry_title)
-                except:
-                    signal.signal(signal.SIGINT, signal.default_int_handler)
-                    try:
-                        if pls_exit:
-                            break
-                        time.sleep(1)
-                    except KeyboardInterrupt:
-                        interrupt()
-                        break
-                    signal.signal(signal.SIGINT, interrupt)
-                else:
+                    entry = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if entry is None:
+                    closed = True
                     break
+                entries.append(entry)
 
-            # Update dict
-            notify_entries[entry_title][1] += 1
+            if not closed:
+                time.sleep(max(last_sent + self.rate_limit - time.monotonic(), 0))
+            self.send(entries)
+            last_sent = time.monotonic()
 
-        if pls_exit:
-            return
+    def send(self, entries: list[list[str]]) -> None:
+        if len(entries) == 1:
+            title = "Feed updated"
+            message = entries[0][0]
+        else:
+            title = "Feed updated with " + str(len(entries)) + " entries"
+            message = "\n".join(entry_title for entry_title, entry_url in entries[:self.batch_size])
+            if len(entries) > self.batch_size:
+                message += "\nand " + str(len(entries) - self.batch_size) + " more"
+
+        for backend in self.backends:
+            for _ in range(3):
+                try:
+                    backend.send(title, message, entries)
+                except Exception as e:
+                    error = e
+                    time.sleep(1)
+                else:
+                    break
+            else:
+                print("[nyaa_notify] Failed to send notification with " + type(backend).__name__ + ": " + str(error), flush=True)
 
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, interrupt)